@@ -0,0 +1,188 @@
+import pandas as pd
+import numpy as np
+import os
+from file_paths import INPUT_FILES
+from translations import LANGUAGES
+
+"""
+Synthetic input files for the benchmarks.
+
+The files have the columns and formats the stages read from the real inputs, with species that
+exercise the same matching paths: most IOC names match on the scientific name, some only on the
+normalized English name or through the Clements-IOC crosswalk, and some not at all.
+Everything is generated from a seed, so the same scale always gives the same files.
+"""
+GENUS_SIZE = 7
+ORDERS = ['Passeriformes', 'Accipitriformes', 'Charadriiformes', 'Anseriformes', 'Piciformes']
+RECORDINGS_PER_SPECIES = 12
+NOTES_HEADER = '#separator:tab\n#html:true\n#guid column:1\n#notetype column:2\n#deck column:3\n#tags column:12\n'
+
+def make_species(count, seed=0):
+    """The species of the synthetic taxonomy, with their eBird code, names and IOC names."""
+    rng = np.random.default_rng(seed)
+    numbers = np.arange(count)
+    species = pd.DataFrame({
+        'SPECIES_CODE': [f'spe{i:05d}' for i in numbers],
+        'English (Clements)': [f"{'Gray' if i % 11 == 0 else 'Spotted'} Bird{'s' if i % 13 == 0 else ''} {i}" for i in numbers],
+        'Scientific (Clements)': [f'Genus{i // GENUS_SIZE} species{i}' for i in numbers],
+        'ORDER': [ORDERS[i % len(ORDERS)] for i in numbers],
+        'FAMILY': [f'Family{i // (GENUS_SIZE * 5)}dae (Family {i // (GENUS_SIZE * 5)})' for i in numbers],
+    })
+
+    # How each species is found in the IOC list: on the scientific name, the normalized English name,
+    # only through the crosswalk, or not at all.
+    species['match'] = rng.choice(['scientific', 'common', 'crosswalk', 'none'], size=count, p=[0.9, 0.05, 0.04, 0.01])
+    species['English (IOC)'] = species['English (Clements)'].str.replace('Gray', 'Grey')
+    species.loc[species['match'] == 'common', 'English (IOC)'] = species['English (IOC)'].str.replace(' ', '-')
+    species.loc[species['match'] == 'crosswalk', 'English (IOC)'] = 'Northern ' + species['English (IOC)']
+    species['Scientific (IOC)'] = species['Scientific (Clements)']
+    renamed = species['match'] != 'scientific'
+    species.loc[renamed, 'Scientific (IOC)'] = species.loc[renamed, 'Scientific (IOC)'].str.replace('Genus', 'Newgenus')
+    return species
+
+def write_taxonomy(species):
+    """eBird taxonomy with species and the other categories that are filtered out."""
+    rows = species[['SPECIES_CODE', 'English (Clements)', 'Scientific (Clements)', 'ORDER', 'FAMILY']].rename(columns={
+        'English (Clements)': 'PRIMARY_COM_NAME',
+        'Scientific (Clements)': 'SCI_NAME',
+    })
+    rows.insert(0, 'CATEGORY', 'species')
+
+    # Every tenth species also has a subspecies group and every genus a spuh.
+    issf = rows.iloc[::10].assign(
+        CATEGORY='issf',
+        SPECIES_CODE=lambda df: df['SPECIES_CODE'] + 'a',
+        PRIMARY_COM_NAME=lambda df: df['PRIMARY_COM_NAME'] + ' (Northern)',
+        SCI_NAME=lambda df: df['SCI_NAME'] + ' borealis',
+    )
+    spuh = rows.iloc[::GENUS_SIZE].assign(
+        CATEGORY='spuh',
+        SPECIES_CODE=lambda df: df['SPECIES_CODE'] + 'x',
+        PRIMARY_COM_NAME=lambda df: df['PRIMARY_COM_NAME'].str.rsplit(' ', n=1).str[0] + ' sp.',
+        SCI_NAME=lambda df: df['SCI_NAME'].str.split(' ').str[0] + ' sp.',
+    )
+    rows = pd.concat([rows, issf, spuh]).sort_index(kind='stable').reset_index(drop=True)
+    rows.insert(0, 'TAXON_ORDER', np.arange(1, len(rows) + 1))
+    rows['SPECIES_GROUP'] = rows['FAMILY'].str.extract(r'\((.*)\)', expand=False)
+    rows.to_csv(INPUT_FILES['ebird_taxonomy'], index=False)
+
+def translation(language, i, rng):
+    """A name in the given language, left out for about a third of the species and sometimes lower case."""
+    value = rng.random()
+    if value < 0.3:
+        return None
+    if value < 0.4:
+        return f'{language[:3].lower()} bird {i}'
+    return f'{language[:3]} Bird {i}'
+
+def write_ioc(species, rng):
+    """The multilingual IOC list, and the outdated Clements-IOC crosswalk."""
+    ioc = species[species['match'] != 'none']
+    workbook = pd.DataFrame({
+        'Seq.': np.arange(len(ioc)),
+        'Order': ioc['ORDER'].str.upper().values,
+        'Family': ioc['FAMILY'].str.split(' ').str[0].values,
+        'IOC14.2': ioc['Scientific (IOC)'].values,
+        'English': ioc['English (IOC)'].values,
+    })
+    for language in LANGUAGES:
+        workbook[language] = [translation(language, i, rng) for i in ioc.index]
+    workbook.to_excel(INPUT_FILES['ioc_translations'], index=False)
+
+    crosswalk = species[species['match'].isin(['crosswalk', 'common'])]
+    pd.DataFrame({
+        'Clements common name': crosswalk['English (Clements)'].values,
+        'Clements scientific name': crosswalk['Scientific (Clements)'].values,
+        'IOC common name': crosswalk['English (IOC)'].values,
+        'IOC scientific name': crosswalk['Scientific (IOC)'].values,
+    }).to_excel(INPUT_FILES['clements_to_ioc'], index=False)
+
+def write_old_version(species, rng):
+    """The first version of the deck, with translations for most of the species."""
+    old = species.sample(frac=0.8, random_state=rng.integers(1 << 31)).sort_index()
+    table = pd.DataFrame({'PRIMARY_COM_NAME': old['English (Clements)'].values, 'SCI_NAME': old['Scientific (Clements)'].values})
+    for language in LANGUAGES:
+        table[language] = [translation(language, i, rng) for i in old.index]
+    table.to_csv(INPUT_FILES['old_version'], index=False)
+
+def write_mnemonics(species, rng):
+    """Mnemonics for a fifth of the species, some keyed on an older spelling of the name."""
+    birds = []
+    for i, name in species['English (Clements)'].sample(frac=0.2, random_state=rng.integers(1 << 31)).items():
+        if i % 3 == 0:
+            name = name.replace('Gray', 'Grey').replace(' ', '-')
+        birds.append('\n'.join([name] + [f'"song {j} of {i}"' for j in range(1 + i % 3)]))
+    with open(INPUT_FILES['mnemonics'], 'w') as f:
+        f.write('\n\n'.join(birds))
+
+def write_audio_archive(species, rng):
+    """DwC-A Occurrence and Multimedia files with recordings and their spectrograms."""
+    count = len(species) * RECORDINGS_PER_SPECIES
+    picks = rng.integers(0, len(species), size=count)
+    occurrence_ids = [f'XC{i:07d}' for i in range(count)]
+
+    scientific = species['Scientific (Clements)'].values[picks].astype(object)
+    # Some recordings are of a subspecies, some only have a vernacular name.
+    subspecies = rng.random(count) < 0.2
+    scientific[subspecies] = scientific[subspecies] + ' minor'
+    scientific[rng.random(count) < 0.05] = None
+
+    pd.DataFrame({
+        'occurrenceID': occurrence_ids,
+        'behavior': rng.choice(['song', 'call', 'call?', 'alarm call', None], size=count),
+        'Associated Taxa': rng.choice([None, None, None, 'Turdus merula'], size=count),
+        'eventDate': [f'20{10 + day % 15:02d}-{1 + day % 12:02d}-{1 + day % 28:02d}' for day in rng.integers(0, 5000, size=count)],
+        'vernacularName': species['English (IOC)'].values[picks],
+        'scientificName': scientific,
+    }).to_csv(INPUT_FILES['audio_data'], index=False)
+
+    recordings = pd.DataFrame({
+        'associatedObservationReference': occurrence_ids,
+        'format': 'audio/mp3',
+        'accessURI': [f'https://xeno-canto.org/{i}/download' for i in range(count)],
+        'description': [f'Length: {seconds} s' for seconds in rng.integers(3, 180, size=count)],
+        'caption': None,
+        'rightsHolder': rng.choice([f'Recordist {i}' for i in range(50)], size=count),
+        'Rating': rng.choice([None, 1, 2, 3, 4, 5], size=count),
+    })
+    spectrograms = recordings.sample(frac=0.8, random_state=rng.integers(1 << 31)).assign(
+        format='image/png',
+        accessURI=lambda df: df['accessURI'].str.replace('download', 'sono.png'),
+        description=None,
+        caption='Spectrogram of the recording',
+        Rating=None,
+    )
+    media = pd.concat([recordings, spectrograms]).sample(frac=1, random_state=rng.integers(1 << 31))
+    media['Rating'] = media['Rating'].astype('Int64')
+    media.to_csv(INPUT_FILES['audio_files'], index=False)
+
+def write_notes(species, ebird_url, rng):
+    """Anki export of the previous version of the deck, with a GUID per note."""
+    notes = species.sample(frac=0.9, random_state=rng.integers(1 << 31)).sort_index()
+    with open(INPUT_FILES['notes'], 'w', encoding='utf-8') as f:
+        f.write(NOTES_HEADER)
+        for i, row in notes.iterrows():
+            fields = [''] * 12
+            fields[0] = f'guid{i:06d}'
+            fields[1] = 'Birds'
+            fields[2] = 'Ultimate Birds'
+            # Some notes are only found on the scientific name or the eBird URL.
+            fields[3] = row['English (Clements)'] if i % 17 else f'Old name {i}'
+            fields[4] = row['Scientific (Clements)']
+            fields[10] = ebird_url + row['SPECIES_CODE'] if i % 5 else ''
+            f.write('\t'.join(fields) + '\n')
+
+def write_fixtures(species, ebird_url, seed=0):
+    """Write every input file for the species to the paths in INPUT_FILES, relative to the working directory."""
+    rng = np.random.default_rng(seed)
+    for path in INPUT_FILES.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    for directory in ['data/processed', 'data/output']:
+        os.makedirs(directory, exist_ok=True)
+
+    write_taxonomy(species)
+    write_ioc(species, rng)
+    write_old_version(species, rng)
+    write_mnemonics(species, rng)
+    write_audio_archive(species, rng)
+    write_notes(species, ebird_url, rng)
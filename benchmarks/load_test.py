@@ -0,0 +1,131 @@
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src'))
+
+from fixtures import make_species, write_fixtures
+from stub_server import StubServer, Faults, point_scrapers_at
+from pipeline import STAGES
+import numpy as np
+import threading
+import tempfile
+import argparse
+import base_data
+import avibase
+import images
+import utils
+import json
+import time
+
+"""
+Load-test the scrapers against the stub server, with the latency, errors and 429s it is configured with.
+
+The scrapers run exactly as in the pipeline, only their fetch_url is timed. The report has the pages per
+second, the p50/p99 time fetch_url took per page (including throttling and retries), the pages that still
+failed, and from the server side the responses per status and the number of retried requests.
+
+    python benchmarks/load_test.py images --species 2000 --latency 0.05 --error-rate 0.05 --throttle-rate 0.02
+"""
+SCRAPERS = {'images': images, 'avibase': avibase}
+SPECIES = 2000
+
+class TimedFetch:
+    """Wraps fetch_url to keep how long each call took and whether it returned a page."""
+    def __init__(self, fetch_url):
+        self.fetch_url = fetch_url
+        self.latencies = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, url, *args, **kwargs):
+        start = time.perf_counter()
+        response = self.fetch_url(url, *args, **kwargs)
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(latency)
+            self.failures += response is None
+        return response
+
+def load_test(scraper, species_count, faults, policy, seed=0):
+    species = make_species(species_count, seed)
+    with StubServer(species, faults=faults) as server:
+        point_scrapers_at(server, policy)
+        write_fixtures(species, base_data.BASE_URL_EBIRD, seed)
+        STAGES['base'].run({})
+        server.reset_counts()
+
+        # The pages are fetched by utils.fetch_and_parse, the Avibase checklist by the scraper itself.
+        modules = [module for module in (utils, SCRAPERS[scraper]) if hasattr(module, 'fetch_url')]
+        fetch = TimedFetch(utils.fetch_url)
+        for module in modules:
+            module.fetch_url = fetch
+        try:
+            start = time.perf_counter()
+            STAGES[scraper].run({})
+            seconds = time.perf_counter() - start
+        finally:
+            for module in modules:
+                module.fetch_url = fetch.fetch_url
+
+        latencies = np.array(fetch.latencies)
+        return {
+            'species': species_count,
+            'pages': len(latencies),
+            'failed_pages': fetch.failures,
+            'seconds': round(seconds, 3),
+            'pages_per_second': round(len(latencies) / seconds, 2),
+            'latency_p50': round(float(np.percentile(latencies, 50)), 4) if len(latencies) else None,
+            'latency_p99': round(float(np.percentile(latencies, 99)), 4) if len(latencies) else None,
+            'server_requests': sum(server.urls.values()),
+            'retries': sum(count - 1 for count in server.urls.values()),
+            'statuses': {str(status): count for status, count in sorted(server.statuses.items())},
+            'server_latency_p50': round(float(np.percentile(server.durations, 50)), 4) if server.durations else None,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the scrapers against a local stub of eBird and Avibase.')
+    parser.add_argument('scrapers', nargs='*', metavar='scraper', help=f'Scrapers to run: {", ".join(SCRAPERS)}. All by default.')
+    parser.add_argument('--species', type=int, default=SPECIES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the server waits before every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with a 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    parser.add_argument('--requests-per-second', type=float, default=utils.REQUESTS_PER_SECOND, help='Throttle of the scrapers')
+    parser.add_argument('--max-retries', type=int, default=utils.MAX_RETRIES)
+    parser.add_argument('--retry-delay', type=float, default=utils.RETRY_DELAY)
+    parser.add_argument('--workers', type=int, default=utils.MAX_WORKERS, help='Concurrent fetches (and connections)')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+    for scraper in args.scrapers:
+        if scraper not in SCRAPERS:
+            parser.error(f'unknown scraper {scraper!r}, choose from {", ".join(SCRAPERS)}')
+
+    utils.MAX_WORKERS = utils.POOL_SIZE = args.workers
+    settings = {key: value for key, value in vars(args).items() if key not in ['scrapers', 'output']}
+    report = {'settings': settings, 'scrapers': {}}
+
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    for scraper in args.scrapers or SCRAPERS:
+        faults = Faults(args.latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after, args.seed)
+        policy = utils.HostPolicy(args.max_retries, args.retry_delay, args.requests_per_second)
+        with tempfile.TemporaryDirectory(prefix='ultimate-birds-load-') as directory:
+            os.chdir(directory)
+            try:
+                report['scrapers'][scraper] = load_test(scraper, args.species, faults, policy, args.seed)
+            finally:
+                os.chdir(cwd)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
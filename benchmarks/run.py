@@ -0,0 +1,132 @@
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src'))
+
+from fixtures import make_species, write_fixtures
+from stub_server import StubServer, point_scrapers_at
+from pipeline import STAGES, upstream
+from file_paths import INPUT_FILES
+import pandas as pd
+import http_cache
+import tempfile
+import tracemalloc
+import platform
+import subprocess
+import argparse
+import shutil
+import base_data
+import utils
+import names
+import json
+import time
+
+"""
+Benchmark every pipeline stage on synthetic inputs at several multiples of a base species count.
+
+Each scale runs in its own temporary directory with fixtures from fixtures.py, and the scrapers fetch
+from a local StubServer instead of eBird and Avibase. Stages run in pipeline order, first to time them
+and then again under tracemalloc for their peak Python memory. The caches are cleared before every
+run, so each one starts cold. The JSON report can be diffed between commits.
+
+    python benchmarks/run.py --species 500 --scales 1 5 20 --output bench.json
+"""
+SPECIES = 500
+SCALES = [1, 5, 20]
+STUB_REQUESTS_PER_SECOND = 1000
+OPTIONS = {'version_tag': 'benchmark', 'streaming': False, 'gzip': False}
+
+def reset_caches():
+    """Forget every on-disk and in-process cache, so the next run starts like a first run."""
+    shutil.rmtree('data/cache', ignore_errors=True)
+    http_cache._response_cache = None
+    utils._workbooks.clear()
+    names._normalized.clear()
+
+def run_stage(stage, options, server):
+    """
+    Seconds the stage takes, the number of pages it requests from the stub server
+    and, from a second run under tracemalloc, its peak memory in bytes.
+    """
+    reset_caches()
+    server.reset_counts()
+    start = time.perf_counter()
+    stage.run(options)
+    seconds = time.perf_counter() - start
+    requests = server.requests.total()
+
+    reset_caches()
+    tracemalloc.start()
+    try:
+        stage.run(options)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': round(seconds, 4), 'peak_bytes': peak, 'requests': requests}
+
+def benchmark_scale(species_count, stages, options, seed):
+    species = make_species(species_count, seed)
+    with StubServer(species) as server:
+        # Without the throttling meant for the real sites.
+        point_scrapers_at(server, utils.HostPolicy(requests_per_second=STUB_REQUESTS_PER_SECOND))
+        write_fixtures(species, base_data.BASE_URL_EBIRD, seed)
+        inputs = {name: os.path.getsize(path) for name, path in INPUT_FILES.items() if os.path.exists(path)}
+
+        results = {}
+        for name in STAGES:
+            if name in stages:
+                print(f'{name} ({species_count} species)')
+                results[name] = run_stage(STAGES[name], options, server)
+    return {'species': species_count, 'input_bytes': inputs, 'stages': results}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and memory-profile the pipeline stages on synthetic inputs.')
+    parser.add_argument('stages', nargs='*', metavar='stage', help=f'Stages to benchmark: {", ".join(STAGES)}. All by default.')
+    parser.add_argument('--species', type=int, default=SPECIES, help='Number of species at scale 1')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help='Multiples of the species count to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--streaming', action='store_true', help='Read the audio archive in chunks')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage {stage!r}, choose from {", ".join(STAGES)}')
+    # Stages need the outputs of the stages they depend on, so those are run (and reported) as well.
+    stages = upstream(args.stages or STAGES)
+    options = {**OPTIONS, 'streaming': args.streaming}
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'seed': args.seed,
+        'options': options,
+        'scales': {},
+    }
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory(prefix='ultimate-birds-bench-') as directory:
+            os.chdir(directory)
+            try:
+                report['scales'][f'{scale}x'] = benchmark_scale(args.species * scale, stages, options, args.seed)
+            finally:
+                os.chdir(cwd)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+from collections import Counter
+from avibase import DIVERSE_COUNTRIES
+import threading
+import random
+import time
+import os
+
+"""
+Local stand-in for eBird and Avibase, so the scrapers can be benchmarked without touching the real sites.
+
+Pages have the markup the scrapers look for and are generated from the synthetic species on request:
+  /species/<code>                      eBird species page with images and identification text
+  /checklist.jsp?lang=EN               Avibase checklist with one reg3 row per country
+  /checklist.jsp?region=<c>            Avibase country checklist
+  /checklist.jsp?region=<c>&list=full  the same checklist with the country's regions expanded
+  /checklist.jsp?region=<c>-<r>        Avibase region checklist
+
+Pages saved from the real sites can be served instead: a file in the recordings directory named after
+the quoted path and query (e.g. quote('/species/comrav', safe='') + '.html') replaces the generated page.
+
+To exercise the scrapers' concurrency, throttling and retries, the server can add latency to every
+response and answer a share of the requests with a 503 or with a 429 and a Retry-After header.
+"""
+OTHER_COUNTRIES = 20
+REGIONS_PER_COUNTRY = 4
+IMAGES_PER_SPECIES = 6
+RARITIES = ['', '', '', 'Rare/Accidental', 'Introduced species', 'Extirpated']
+
+class StubSite:
+    def __init__(self, species, recordings=None):
+        self.species = species.reset_index(drop=True)
+        self.codes = {code: i for i, code in enumerate(self.species['SPECIES_CODE'])}
+        self.countries = list(DIVERSE_COUNTRIES) + [f'Country {i}' for i in range(OTHER_COUNTRIES)]
+        self.recordings = recordings
+
+    def recorded_page(self, url):
+        if not self.recordings:
+            return None
+        path = os.path.join(self.recordings, quote(url, safe='') + '.html')
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def page(self, url):
+        """Status and body for a request, or 404 for anything the real sites would not have."""
+        recorded = self.recorded_page(url)
+        if recorded is not None:
+            return 200, recorded
+
+        parsed = urlparse(url)
+        path, query = parsed.path, parse_qs(parsed.query)
+        if path.startswith('/species/') and path[len('/species/'):] in self.codes:
+            return 200, self.ebird_page(self.codes[path[len('/species/'):]])
+        if path == '/checklist.jsp':
+            region = query.get('region', [None])[0]
+            if region is None:
+                return 200, self.checklist_page()
+            country, _, subregion = region.partition('-')
+            if country.isdigit() and int(country) < len(self.countries):
+                if subregion.isdigit():
+                    return 200, self.region_page(int(country), int(subregion))
+                return 200, self.country_page(int(country), expanded='list' in query)
+        return 404, '<html><body>Not found</body></html>'
+
+    def ebird_page(self, i):
+        figures = ''.join(
+            f'<figure><img src="https://cdn.example.org/asset/{i * IMAGES_PER_SPECIES + n}/320">'
+            f'<figcaption>{"<span>Adult</span>" if n % 2 else ""}<span>©\xa0Photographer {n}</span></figcaption></figure>'
+            for n in range(IMAGES_PER_SPECIES)
+        )
+        name = self.species.at[i, 'English (Clements)']
+        return (f'<html><head><title>{name} - eBird</title></head><body><main>'
+                f'<div class="Hero-image">{figures}</div>'
+                f'<p class="u-stack-sm">Small bird {i} with a {"long" if i % 2 else "short"} tail.</p>'
+                f'</main></body></html>')
+
+    def checklist_page(self):
+        rows = ''.join(
+            f'<tr class="reg3"><td><a href="checklist.jsp?region={c}">{country}</a> '
+            f'<a href="checklist.jsp?region={c}&amp;list=full">+</a></td></tr>'
+            for c, country in enumerate(self.countries)
+        )
+        return f'<html><body><table>{rows}</table></body></html>'
+
+    def bird_rows(self, seed, every):
+        rows = []
+        for i in range(seed % every, len(self.species), every):
+            rarity = RARITIES[(i + seed) % len(RARITIES)]
+            breeding = '<font color="blue">Breeding endemic</font>' if (i + seed) % 23 == 0 else ''
+            status = '<font color="red">Vulnerable</font>' if i % 19 == 0 else ''
+            rows.append(
+                f'<tr class="highlight1"><td>{self.species.at[i, "English (Clements)"]}</td>'
+                f'<td><a href="species.jsp?lang=EN&amp;avibaseid={self.species.at[i, "SPECIES_CODE"]}">'
+                f'<i>{self.species.at[i, "Scientific (Clements)"]}</i></a></td>'
+                f'<td>{rarity} {breeding}{status}</td></tr>'
+            )
+        return ''.join(rows)
+
+    def country_page(self, c, expanded=False):
+        regions = ''
+        if expanded:
+            regions = ''.join(
+                f'<tr class="reg{4 + r % 3}"><td><a href="checklist.jsp?region={c}-{r}">Region {r}</a></td></tr>'
+                for r in range(REGIONS_PER_COUNTRY)
+            )
+        return f'<html><body><table>{regions}</table><table>{self.bird_rows(c, 4)}</table></body></html>'
+
+    def region_page(self, c, r):
+        return f'<html><body><table>{self.bird_rows(c * REGIONS_PER_COUNTRY + r, 8)}</table></body></html>'
+
+
+class Faults:
+    """Latency and failures added to the responses, drawn from a seeded generator so runs can be repeated."""
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        """Seconds to wait before answering, and the status to answer with instead of the page (or None)."""
+        with self.lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return delay, 429
+        if roll < self.throttle_rate + self.error_rate:
+            return delay, 503
+        return delay, None
+
+
+class StubServer:
+    """
+    Serve a StubSite on a free local port from a background thread.
+    Counts the requests per kind of page, per status and per URL (so retries show up as URLs requested more than once),
+    and keeps the time each response took.
+    """
+    def __init__(self, species, host='127.0.0.1', port=0, faults=None, recordings=None):
+        site = self.site = StubSite(species, recordings)
+        faults = self.faults = faults or Faults()
+        counts = self.requests = Counter()
+        statuses = self.statuses = Counter()
+        urls = self.urls = Counter()
+        durations = self.durations = []
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                start = time.perf_counter()
+                delay, fault = faults.draw()
+                if delay:
+                    time.sleep(delay)
+                status, body = site.page(self.path) if fault is None else (fault, f'<html><body>{fault}</body></html>')
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                if status == 429:
+                    self.send_header('Retry-After', str(faults.retry_after))
+                self.end_headers()
+                self.wfile.write(body)
+                with lock:
+                    counts['ebird' if self.path.startswith('/species/') else 'avibase'] += 1
+                    statuses[status] += 1
+                    urls[self.path] += 1
+                    durations.append(time.perf_counter() - start)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset_counts(self):
+        for counter in [self.requests, self.statuses, self.urls]:
+            counter.clear()
+        self.durations.clear()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def point_scrapers_at(server, policy):
+    """Send the images and Avibase scrapers to the stub server, fetching from it with the given HostPolicy."""
+    import base_data
+    import avibase
+    import utils
+
+    base_data.BASE_URL_EBIRD = server.url + '/species/'
+    avibase.BASE_URL_AVIBASE = server.url + '/'
+    avibase.CHECKLIST_URL = avibase.BASE_URL_AVIBASE + 'checklist.jsp?lang=EN'
+    utils.HOST_POLICIES[urlparse(server.url).netloc] = policy
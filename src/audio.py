@@ -1,104 +1,307 @@
 import pandas as pd
-from file_paths import INPUT_FILES, PROCESSED_FILES
+import numpy as np
+import hashlib
+import os
+from pandas.api.types import union_categoricals
+from file_paths import INPUT_FILES, PROCESSED_FILES, CACHE_FILES
+from utils import file_hash
+from names import normalize_names
+from taxonomy_diff import split_unchanged, with_reused
+from store import save_to_store
+from metrics import count, timer, timed_io
+
+MEDIA_COLUMNS = ['associatedObservationReference', 'format', 'accessURI', 'description', 'caption', 'rightsHolder', 'Rating']
+STREAMING_MEDIA_COLUMNS = ['associatedObservationReference', 'format', 'accessURI', 'description', 'rightsHolder', 'Rating']
+OCCURRENCE_COLUMNS = ['occurrenceID', 'behavior', 'Associated Taxa', 'eventDate', 'vernacularName', 'scientificName']
+CATEGORICAL_COLUMNS = ['format', 'rightsHolder', 'scientificName']
+AUDIO_KEYS = ['scientificName', 'vernacularName', 'vernacularKey']
+# Keys holding the normalized names (see names.py) of an archive column.
+NORMALIZED_KEYS = {'vernacularKey': 'vernacularName'}
+# Names each species is matched on, in order of priority.
+KEY_RESOLUTION = [
+    ('Scientific (Clements)', 'scientificName'),
+    ('English (Clements)', 'vernacularName'),
+    ('Scientific (IOC)', 'scientificName'),
+    ('English (IOC)', 'vernacularName'),
+    ('English (Clements)', 'vernacularKey'),
+    ('English (IOC)', 'vernacularKey'),
+]
+MAX_RECORDINGS = 10
+MAX_DURATIONS = [30, 60, np.inf]
+STREAMING_CHUNK_SIZE = 100_000
 
 def create_anki_audio(aud_type, credit, file, spectrogram):
     aud_type = '' if pd.isna(aud_type) else aud_type.replace('?', '')
     return f'<div class="aud-w-txt"><div class="aud-type">{aud_type}</div><div class="aud-credit">© {credit}</div><audio controls="" controlslist="nodownload noplaybackrate"><source src="{file}" type="audio/mpeg"></audio><img src="{spectrogram}"></div>'
 
-def get_audio(base_df):
-    print('-------- Scraping audio --------')
-    df = base_df[['Scientific (Clements)', 'English (Clements)', 'Scientific (IOC)', 'English (IOC)']].copy()
-    df['SOUNDS'] = pd.NA
+def read_archive_file(path, columns, dtype=None):
+    """
+    Read columns from a DwC-A text file through a Parquet snapshot of it.
+    The snapshot is created the first time a version of the file is read and is keyed by its hash,
+    so later runs skip CSV parsing and only memory-map the columns they need.
+    Repeated values such as the format, rights holder and species name are stored as categories.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print('pyarrow is not installed, reading the audio archive without the columnar cache')
+        return pd.read_csv(path, usecols=columns, encoding='UTF-8', dtype=dtype)
+
+    columns_key = hashlib.sha256(','.join(columns).encode()).hexdigest()[:8]
+    name = os.path.splitext(os.path.basename(path))[0]
+    snapshot = os.path.join(CACHE_FILES['audio'], f'{name}-{file_hash(path)[:16]}-{columns_key}.parquet')
+
+    if not os.path.exists(snapshot):
+        print(f'Converting {path} to {snapshot}')
+        categories = {col: 'category' for col in CATEGORICAL_COLUMNS if col in columns}
+        df = pd.read_csv(path, usecols=columns, encoding='UTF-8', dtype={**categories, **(dtype or {})})
+        os.makedirs(CACHE_FILES['audio'], exist_ok=True)
+        df.to_parquet(snapshot + '.tmp', index=False)
+        os.replace(snapshot + '.tmp', snapshot)
+        return df
+
+    return pd.read_parquet(snapshot, columns=columns, memory_map=True)
+
+def select_audio(audio, key, names):
+    """
+    Build the Anki HTML of the ten best recordings for each of the given names in the key column.
+    Every species is handled in the same vectorized pass instead of one DataFrame per species.
+    """
+    audio = audio[audio[key].isin(names)]
+
+    # Avoid similar recordings made by the same person on the same day.
+    audio = audio.drop_duplicates(subset=[key, 'rightsHolder', 'eventDate'])
+
+    # Prioritise audio files with a maximum length of 30 seconds.
+    audio = audio.dropna(subset=['description'])
+    audio = audio.assign(duration=audio['description'].str.extract(r'(\d+) s', expand=False).astype(int))
+    # If a species has at least one recording <= 30 seconds, use only those.
+    # Otherwise, if there is at least one recording <= 60 seconds, use those, else use recordings of any length.
+    shortest = audio.groupby(key)['duration'].transform('min')
+    max_duration = np.select([shortest <= limit for limit in MAX_DURATIONS[:-1]], MAX_DURATIONS[:-1], np.inf)
+    audio = audio[audio['duration'] <= max_duration]
 
-    # Load and merge audio datasets
-    media_df = pd.read_csv(INPUT_FILES['audio_files'], usecols=['associatedObservationReference', 'format', 'accessURI', 'description', 'caption', 'rightsHolder', 'Rating'], encoding='UTF-8', dtype={'Rating': 'Int64'})
-    occurrence_df = pd.read_csv(INPUT_FILES['audio_data'], usecols=['occurrenceID', 'behavior', 'Associated Taxa', 'eventDate', 'vernacularName', 'scientificName'])
+    audio = audio.assign(Rating=audio['Rating'].fillna(1))
+
+    # Priority is given to recording with no additional species in the backgorund and a rating of 3 or higher.
+    audio = audio.assign(background_priority=(audio['Associated Taxa'].isna() & (audio['Rating'] >= 3)).astype(int))
+
+    # Sort by priorities and rating within each species (stable, so ties keep the archive order).
+    audio = audio.sort_values([key, 'background_priority', 'Rating', 'duration'], ascending=[True, False, False, True], kind='stable')
+    audio = audio.groupby(key, sort=False).head(MAX_RECORDINGS)
+
+    # Create the HTML snippet from each audio match.
+    audio_html = pd.Series([
+        create_anki_audio(behavior, credit, file, spectrogram)
+        for behavior, credit, file, spectrogram
+        in zip(audio['behavior'], audio['rightsHolder'], audio['accessURI'], audio['spectrogram'])
+    ], index=audio[key], dtype=object)
+    return audio_html.groupby(level=0, sort=False).agg(''.join)
+
+def resolve_audio_keys(df, present_names):
+    """
+    Resolve which archive name each species is matched on: Clements scientific, Clements English, IOC scientific, IOC English
+    and finally the normalized Clements and IOC English names, for vernacular names that are only spelled differently.
+    A name matches when any file in the archive has it, even if none of them end up being used.
+    """
+    df['AUDIO_KEY'] = pd.NA
+    df['AUDIO_KEY_COLUMN'] = pd.NA
+    for name_col, key in KEY_RESOLUTION:
+        names = normalize_names(df[name_col]) if key in NORMALIZED_KEYS else df[name_col]
+        found = df['AUDIO_KEY'].isna() & names.isin(present_names[key])
+        df.loc[found, 'AUDIO_KEY'] = names[found]
+        df.loc[found, 'AUDIO_KEY_COLUMN'] = key
+
+def species_name(scientific_names):
+    """Replace subspecies with species name"""
+    return scientific_names.str.split(' ').str[:2].str.join(' ')
+
+def load_audio():
+    """Load and merge the full audio archive, returning the merged table and its mp3 files with their spectrograms."""
+    with timed_io('read', INPUT_FILES['audio_files']):
+        media_df = read_archive_file(INPUT_FILES['audio_files'], MEDIA_COLUMNS, dtype={'Rating': 'Int64'})
+    with timed_io('read', INPUT_FILES['audio_data']):
+        occurrence_df = read_archive_file(INPUT_FILES['audio_data'], OCCURRENCE_COLUMNS)
 
     # Merge audio data on occurrence ID
-    merged_audio = pd.merge(media_df, occurrence_df, left_on='associatedObservationReference', right_on='occurrenceID', how='inner')
+    with timer('merge_seconds', step='audio occurrences'):
+        merged_audio = pd.merge(media_df, occurrence_df, left_on='associatedObservationReference', right_on='occurrenceID', how='inner')
+    count('rows_processed_total', len(merged_audio), step='audio files')
     print(f'Found {len(merged_audio)} audio files')
 
-    # Replace subspecies with species name
-    merged_audio['scientificName'] = merged_audio['scientificName'].str.split(' ').str[:2].str.join(' ')
-
-    # Precompute dictionaries for fast lookup.
-    # Group by scientificName and vernacularName so that for each species we avoid filtering the whole DataFrame.
-    sci_dict = {name: group for name, group in merged_audio.groupby('scientificName')}
-    vern_dict = {name: group for name, group in merged_audio.groupby('vernacularName')}
-
-    def process_species_audio(species_row):
-        sci_name = species_row['Scientific (Clements)']
-        com_name = species_row['English (Clements)']
-        sci_name_ioc = species_row['Scientific (IOC)']
-        com_name_ioc = species_row['English (IOC)']
-        matches = None
-        if sci_name in sci_dict:
-            matches = sci_dict[sci_name]
-        elif com_name in vern_dict:
-            matches = vern_dict[com_name]
-        elif sci_name_ioc in sci_dict:
-            matches = sci_dict[sci_name_ioc]
-        elif com_name_ioc in vern_dict:
-            matches = vern_dict[com_name_ioc]
-        if matches is not None:
-            audio_files = matches[matches['format'] == 'audio/mp3']
-
-            # Filter for spectrogram rows: those with a caption starting with "Spectrogram"
-            matches['caption'] = matches['caption'].fillna('')
-            spectrogram_rows = matches[matches['caption'].str.startswith("Spectrogram")]
-
-            # Build a mapping from associatedObservationReference to spectrogram URL (here assumed to be in 'accessURI')
-            spec_map = spectrogram_rows.set_index('associatedObservationReference')['accessURI']
-
-            # For each row in audio_files, map its associatedObservationReference to the spectrogram URL
-            audio_files['spectrogram'] = audio_files['associatedObservationReference'].map(spec_map)
-            
-            # Avoid similar recordings made by the same person on the same day.
-            audio_files = audio_files.drop_duplicates(subset=['rightsHolder', 'eventDate'])
-
-            # Prioritise audio files with a maximum length of 30 seconds.
-            audio_files = audio_files.dropna(subset=['description'])
-            audio_files['duration'] = audio_files['description'].str.extract(r'(\d+) s').astype(int)
-            if not audio_files[audio_files['duration'] <= 30].empty:
-                # If there is at least one recording <= 30 seconds, use only those.
-                audio_files = audio_files[audio_files['duration'] <= 30]
-            elif not audio_files[audio_files['duration'] <= 60].empty:
-                # Otherwise, if there is at least one recording <= 60 seconds, use those.
-                audio_files = audio_files[audio_files['duration'] <= 60]
-            # Else, leave audio_files as is (i.e. use recordings of any length).
-
-            audio_files['Rating'] = audio_files['Rating'].fillna(1)
-
-            # Priority is given to recording with no additional species in the backgorund and a rating of 3 or higher.
-            audio_files['background_priority'] = audio_files.apply(
-                lambda row: 1 if pd.isna(row['Associated Taxa']) and row['Rating'] >= 3
-                            else 0,
-                axis=1
-            )
-
-            # Sort by priorities and rating.
-            audio_files = audio_files.sort_values(['background_priority', 'Rating', 'duration'], ascending=[False, False, True])
-
-            unique_audio = audio_files.head(10)
-            # Create the HTML snippet from each audio match.
-            audio_html = ''.join(
-                create_anki_audio(
-                    audio_row['behavior'],
-                    audio_row['rightsHolder'],
-                    audio_row['accessURI'],
-                    audio_row['spectrogram']
-                )
-                for _, audio_row in unique_audio.iterrows()
-            )
-            return audio_html
-        else:
-            return ''
-
-    # Apply the per-species processing (this is still row-by-row but each lookup is fast).
-    df['SOUNDS'] = df.apply(process_species_audio, axis=1)
+    merged_audio['scientificName'] = species_name(merged_audio['scientificName'])
+    for key, column in NORMALIZED_KEYS.items():
+        merged_audio[key] = normalize_names(merged_audio[column])
+
+    # Map each recording to the spectrogram of its observation: those with a caption starting with "Spectrogram"
+    spectrograms = merged_audio[merged_audio['caption'].fillna('').str.startswith('Spectrogram')]
+    spectrograms = spectrograms.drop_duplicates(subset='associatedObservationReference').set_index('associatedObservationReference')['accessURI']
+    audio_files = merged_audio[merged_audio['format'] == 'audio/mp3']
+    audio_files = audio_files.assign(spectrogram=audio_files['associatedObservationReference'].map(spectrograms))
+
+    return merged_audio, audio_files
+
+def hash_columns(df):
+    """A 64-bit hash of every row of df, NaN included."""
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+def read_occurrences(wanted_names):
+    """
+    The occurrences of the wanted names, read in chunks and kept in compact columns: the hash of their ID, the code of
+    their name in each list of wanted names (-1 when it isn't wanted), whether no other species are in the background,
+    the hash of their date and their behavior as a category.
+    """
+    frames = []
+    for chunk in pd.read_csv(INPUT_FILES['audio_data'], usecols=OCCURRENCE_COLUMNS, dtype={'behavior': 'category'}, chunksize=STREAMING_CHUNK_SIZE):
+        chunk['scientificName'] = species_name(chunk['scientificName'])
+        for key, column in NORMALIZED_KEYS.items():
+            chunk[key] = normalize_names(chunk[column])
+        codes = {key: pd.Categorical(chunk[key], categories=wanted_names[key]).codes for key in AUDIO_KEYS}
+        wanted = np.logical_or.reduce([codes[key] >= 0 for key in AUDIO_KEYS])
+        frames.append(pd.DataFrame({
+            'occurrence': hash_columns(chunk['occurrenceID'])[wanted],
+            **{key: codes[key][wanted] for key in AUDIO_KEYS},
+            'no_background': chunk['Associated Taxa'].isna().to_numpy()[wanted],
+            'date': hash_columns(chunk['eventDate'])[wanted],
+            'behavior': chunk['behavior'].array[wanted],
+        }))
+
+    # Chunks have their own behavior categories.
+    behavior = union_categoricals([frame['behavior'] for frame in frames])
+    occurrences = pd.concat([frame.drop(columns='behavior') for frame in frames], ignore_index=True)
+    occurrences['behavior'] = behavior
+    return occurrences
+
+def stream_audio(df):
+    """
+    Select recordings while reading the archive in chunks of STREAMING_CHUNK_SIZE rows.
+
+    The occurrences of species in the base taxonomy are kept in compact columns (see read_occurrences), about
+    40 bytes each, and similar recordings are skipped with a sorted array of 64-bit hashes, 8 bytes per recording.
+    Every name keeps its MAX_RECORDINGS best recordings under the shortest duration limit it has any for, ranked like
+    select_audio (background priority, rating, duration and then archive order), so the rest of the memory scales
+    with the number of species.
+
+    Returns the archive names that were found and the HTML per name, like the in-memory path.
+    """
+    wanted_names = {
+        'scientificName': set(df['Scientific (Clements)'].dropna()) | set(df['Scientific (IOC)'].dropna()),
+        'vernacularName': set(df['English (Clements)'].dropna()) | set(df['English (IOC)'].dropna()),
+        'vernacularKey': set(normalize_names(df['English (Clements)']).dropna()) | set(normalize_names(df['English (IOC)']).dropna()),
+    }
+    wanted_names = {key: sorted(names) for key, names in wanted_names.items()}
+    occurrences = read_occurrences(wanted_names)
+
+    present_codes = {key: set() for key in AUDIO_KEYS}
+    seen_recordings = {key: np.array([], dtype=np.uint64) for key in AUDIO_KEYS}
+    best = {key: {} for key in AUDIO_KEYS}
+    audio_count = 0
+    row_offset = 0
+    for chunk in pd.read_csv(INPUT_FILES['audio_files'], usecols=STREAMING_MEDIA_COLUMNS, encoding='UTF-8', dtype={'Rating': 'Int64'}, chunksize=STREAMING_CHUNK_SIZE):
+        # Remember each file's position in the archive, it decides the order of otherwise equal recordings.
+        chunk.index = pd.RangeIndex(row_offset, row_offset + len(chunk), name='position')
+        row_offset += len(chunk)
+        chunk['occurrence'] = hash_columns(chunk['associatedObservationReference'])
+        merged = chunk.reset_index().merge(occurrences, on='occurrence', how='inner')
+        audio_count += len(merged)
+        count('rows_processed_total', len(chunk), step='audio files')
+
+        mp3 = merged[merged['format'] == 'audio/mp3']
+        mp3 = mp3.assign(duration=mp3['description'].str.extract(r'(\d+) s', expand=False))
+        for key in AUDIO_KEYS:
+            present_codes[key].update(merged.loc[merged[key] >= 0, key].unique())
+            seen_recordings[key] = keep_best(mp3[mp3[key] >= 0], key, seen_recordings[key], best[key])
+    print(f'Found {audio_count} audio files')
+
+    # Each name is under the shortest duration limit that has any of its recordings, best first.
+    selected = {key: pd.concat(best[key].values()) for key in AUDIO_KEYS if best[key]}
+
+    # Only the spectrograms of the selected recordings are looked up.
+    observations = np.concatenate([recordings['occurrence'].to_numpy() for recordings in selected.values()] or [[]])
+    spectrograms = {}
+    for chunk in pd.read_csv(INPUT_FILES['audio_files'], usecols=['associatedObservationReference', 'accessURI', 'caption'], encoding='UTF-8', chunksize=STREAMING_CHUNK_SIZE):
+        occurrences = hash_columns(chunk['associatedObservationReference'])
+        found = np.isin(occurrences, observations) & chunk['caption'].fillna('').str.startswith('Spectrogram').to_numpy()
+        for observation, uri in zip(occurrences[found], chunk['accessURI'][found]):
+            spectrograms.setdefault(observation, uri)
+
+    present_names = {key: {wanted_names[key][code] for code in present_codes[key]} for key in AUDIO_KEYS}
+    audio_html = {key: {} for key in AUDIO_KEYS}
+    for key, recordings in selected.items():
+        audio_html[key] = pd.Series([
+            create_anki_audio(behavior, credit, file, spectrograms.get(observation, np.nan))
+            for behavior, credit, file, observation
+            in zip(recordings['behavior'], recordings['rightsHolder'], recordings['accessURI'], recordings['occurrence'])
+        ], index=np.array(wanted_names[key], dtype=object)[recordings[key]], dtype=object).groupby(level=0, sort=False).agg(''.join).to_dict()
+    return present_names, audio_html
+
+def keep_best(audio, key, seen_recordings, best):
+    """
+    Add a chunk of mp3 files to the MAX_RECORDINGS best recordings per name and duration limit kept by stream_audio.
+    Returns the hashes of the recordings seen so far, with the ones of this chunk.
+    """
+    # Avoid similar recordings made by the same person on the same day, keeping the first one in the archive.
+    # The hashes of the recordings seen so far are kept sorted, so new ones are found and inserted with a binary search.
+    recordings = hash_columns(audio[[key, 'rightsHolder', 'date']])
+    positions = np.searchsorted(seen_recordings, recordings)
+    inside = positions < len(seen_recordings)
+    seen = np.zeros(len(recordings), dtype=bool)
+    seen[inside] = seen_recordings[positions[inside]] == recordings[inside]
+    first = ~pd.Series(recordings).duplicated().to_numpy() & ~seen
+    new = np.unique(recordings[first])
+    seen_recordings = np.insert(seen_recordings, np.searchsorted(seen_recordings, new), new)
+    audio = audio[first].dropna(subset=['description'])
+
+    audio = audio.assign(duration=audio['duration'].astype(int), Rating=audio['Rating'].fillna(1))
+    audio = audio.assign(background_priority=(audio['no_background'] & (audio['Rating'] >= 3)).astype(int))
+    audio = audio[[key, 'background_priority', 'Rating', 'duration', 'position', 'behavior', 'rightsHolder', 'accessURI', 'occurrence']]
+
+    # Higher is better: background priority, rating, shorter duration and then earlier in the archive.
+    # A name with recordings under a shorter limit never uses a longer one, so it is only kept for the shortest.
+    shorter = set()
+    for max_duration in MAX_DURATIONS:
+        candidates = pd.concat([best.get(max_duration), audio[audio['duration'] <= max_duration]])
+        candidates = candidates[~candidates[key].isin(shorter)]
+        shorter.update(candidates[key].unique())
+        candidates = candidates.sort_values([key, 'background_priority', 'Rating', 'duration', 'position'],
+                                            ascending=[True, False, False, True, True], kind='stable')
+        best[max_duration] = candidates.groupby(key, sort=False).head(MAX_RECORDINGS)
+    return seen_recordings
+
+def get_audio(base_df, streaming=False, incremental=False):
+    """
+    Select up to ten recordings per species from the GBIF wildlife sounds archive.
+    With streaming set, the archive is read in chunks instead of being loaded and merged in memory.
+    With incremental set, only species that changed since the previous version get new recordings (see taxonomy_diff.py).
+    """
+    print('-------- Scraping audio --------')
+    df = base_df[['Scientific (Clements)', 'English (Clements)', 'Scientific (IOC)', 'English (IOC)']].copy()
+    reused = None
+    if incremental:
+        df, reused = split_unchanged(df, PROCESSED_FILES['audio'])
+    df['SOUNDS'] = pd.NA
+
+    if streaming:
+        present_names, audio_html = stream_audio(df)
+        resolve_audio_keys(df, present_names)
+    else:
+        merged_audio, audio_files = load_audio()
+        resolve_audio_keys(df, {key: set(merged_audio[key].dropna()) for key in AUDIO_KEYS})
+        audio_html = {
+            key: select_audio(audio_files, key, set(df.loc[df['AUDIO_KEY_COLUMN'] == key, 'AUDIO_KEY']))
+            for key in AUDIO_KEYS
+        }
+
+    for key in AUDIO_KEYS:
+        matched = df['AUDIO_KEY_COLUMN'] == key
+        df.loc[matched, 'SOUNDS'] = df.loc[matched, 'AUDIO_KEY'].map(audio_html[key])
 
     df['SOUNDS'] = df['SOUNDS'].replace('', pd.NA)
     print(f'Found audio for {df["SOUNDS"].count()} species')
+    df = with_reused(df[['Scientific (Clements)', 'SOUNDS']], reused, base_df['Scientific (Clements)'])
 
     # Save the final DataFrame.
-    df[['Scientific (Clements)', 'SOUNDS']].to_csv(PROCESSED_FILES['audio'], index=False)
\ No newline at end of file
+    count('rows_processed_total', len(df))
+    with timed_io('write', PROCESSED_FILES['audio']):
+        df.to_csv(PROCESSED_FILES['audio'], index=False)
+    save_to_store('audio')
\ No newline at end of file
@@ -1,96 +1,152 @@
-from bs4 import BeautifulSoup
-import requests
-from requests.exceptions import RequestException
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-import pandas as pd
-import numpy as np
+from bs4 import BeautifulSoup, SoupStrainer
+from collections import defaultdict
 from file_paths import PROCESSED_FILES
-from utils import fetch_url
-from tqdm import tqdm
+from utils import fetch_url, map_concurrent, fetch_and_parse, has_class
+from journal import Journal, finish_journal
+from store import save_to_store
+from metrics import count, timer, timed_io
 
 BASE_URL_AVIBASE = "https://avibase.bsc-eoc.org/"
+CHECKLIST_URL = BASE_URL_AVIBASE + 'checklist.jsp?lang=EN'
 DIVERSE_COUNTRIES = {
     'Australia': 275, 'Brazil': 67, 'Canada': 6, 'China': 239, 'Colombia': 58,
     'Ecuador': 64, 'India': 244, 'Indonesia': 268, 'Peru': 65, 
     'Russian Federation': 230, 'United States': 8
 }
 XPATH = '/html/body/div[1]/div[4]/div/div[5]/table/tr[{}]/td[1]/a[2]'
+USE_SELENIUM = False  # Opt-in fallback: discover countries and regions with a headless Chrome instead of plain HTTP
+# Only the rows that are read are built into a tree, the rest of a page is skipped.
+CHECKLIST_PARSE_ONLY = SoupStrainer('tr', class_=has_class('reg3'))
+REGIONS_PARSE_ONLY = SoupStrainer('tr', class_=has_class('reg4', 'reg5', 'reg6'))
+BIRDS_PARSE_ONLY = SoupStrainer('tr', class_=has_class('highlight1'))
+
+class AvibaseResults:
+    """
+    Collects scraped data per English (Clements) name so the DataFrame is only touched once at the end.
+    Tags keep the order in which they were scraped, while the Avibase URL and conservation status
+    come from the first country that lists the species.
+    """
+    def __init__(self):
+        self.tags = defaultdict(list)
+        self.details = {}
+
+    def add_tag(self, name, tag):
+        if tag:
+            self.tags[name].append(tag)
+
+    def add_details(self, name, avibase_url, conservation_status):
+        if name not in self.details:
+            self.details[name] = (avibase_url, conservation_status)
+
+    def apply(self, df):
+        names = df['English (Clements)']
+        df['TAGS'] = names.map({name: ''.join(tags) for name, tags in self.tags.items()}).fillna('')
+        df['AVIBASE'] = names.map({name: url for name, (url, _) in self.details.items()})
+        df['CONS_STATUS'] = names.map({name: status for name, (_, status) in self.details.items()})
+        return df
 
 def initialize_webdriver():
     """Initialize and return a Selenium WebDriver instance."""
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+
     service = Service()
     options = webdriver.ChromeOptions()
     options.add_experimental_option('excludeSwitches', ['enable-logging'])
     driver = webdriver.Chrome(service=service, options=options)
     return driver
 
-def fetch_country_regions(driver, country_name):
-    """Fetch <a> tags for regions in a given country."""
-    country_code = DIVERSE_COUNTRIES.get(country_name)
-    if not country_code:
-        return []
+def fetch_page_source_selenium(country_name=None):
+    """Load the checklist in Chrome, optionally expanding a country, and return the page source."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
 
+    driver = initialize_webdriver()
     try:
-        driver.get(BASE_URL_AVIBASE + 'checklist.jsp?lang=EN')
-        WebDriverWait(driver, 3).until(EC.presence_of_element_located((By.CLASS_NAME, 'reg3')))
-        
-        # Select country
-        driver.find_element(By.XPATH, XPATH.format(country_code)).click()
-        WebDriverWait(driver, 3).until(EC.presence_of_element_located((By.CLASS_NAME, 'reg6')))
-
-        # Parse regions
-        soup = BeautifulSoup(driver.page_source, 'lxml')
-        tr_class = 'reg4' if country_name == 'Russian Federation' else ['reg4', 'reg5', 'reg6']
-        return [tr.td.a for tr in soup.find_all('tr', class_=tr_class)]
-        
-    except Exception as e:
-        print(f"Error fetching regions for {country_name}: {str(e)}")
+        driver.get(CHECKLIST_URL)
+        WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CLASS_NAME, 'reg3')))
+        if country_name:
+            # Select country
+            driver.find_element(By.XPATH, XPATH.format(DIVERSE_COUNTRIES[country_name])).click()
+            WebDriverWait(driver, 3).until(EC.presence_of_element_located((By.CLASS_NAME, 'reg6')))
+        return driver.page_source
+    finally:
+        driver.quit()
+
+def fetch_country_list():
+    """Fetch the <tr> rows of all countries on the checklist page."""
+    if not USE_SELENIUM:
+        response = fetch_url(CHECKLIST_URL)
+        if response:
+            with timer('html_parse_seconds', parser='checklist'):
+                country_rows = BeautifulSoup(response.content, 'lxml', parse_only=CHECKLIST_PARSE_ONLY).find_all('tr', class_='reg3')
+            if country_rows:
+                return country_rows
+        print("No countries found over HTTP, set USE_SELENIUM to load the checklist in Chrome.")
         return []
+    return BeautifulSoup(fetch_page_source_selenium(), 'lxml', parse_only=CHECKLIST_PARSE_ONLY).find_all('tr', class_='reg3')
+
+def region_list_url(country_row, country_name):
+    """
+    The second link of a country row leads to the checklist with the country's regions expanded,
+    which is the same page Selenium gets to by clicking it.
+    """
+    links = country_row.td.find_all('a')
+    href = links[1].get('href', '') if len(links) > 1 else ''
+    if not href or href.startswith('javascript:'):
+        print(f"No region link found for {country_name}, set USE_SELENIUM to expand it in Chrome.")
+        return None
+    return BASE_URL_AVIBASE + href
 
-def scrape_region_data(df, region_url, country_name, region_name):
-    """Scrape data for a single region and update DataFrame."""
+def parse_region_links(content, country_name):
+    """The (href, name) of every region on a checklist page with the country's regions expanded."""
+    soup = BeautifulSoup(content, 'lxml', parse_only=REGIONS_PARSE_ONLY)
+    tr_class = 'reg4' if country_name == 'Russian Federation' else ['reg4', 'reg5', 'reg6']
+    return [(tr.td.a['href'], tr.td.a.text) for tr in soup.find_all('tr', class_=tr_class)]
+
+def fetch_region_links_selenium(country_name):
+    """Expand the country's regions in Chrome and return their (href, name), or None if that failed."""
     try:
-        response = fetch_url(region_url)
-        if not response:
-            return
+        return parse_region_links(fetch_page_source_selenium(country_name), country_name)
+    except Exception as e:
+        print(f"Error fetching regions for {country_name}: {str(e)}")
+        return None
 
-        soup = BeautifulSoup(response.content, 'lxml')
-        
-        # Use passed region_name instead of parsing from URL
-        region_name = region_name.strip()
+def parse_region_page(content, country_name, region_name):
+    """The (name, tag) pairs of the birds on a region's checklist page."""
+    birds = []
+    soup = BeautifulSoup(content, 'lxml', parse_only=BIRDS_PARSE_ONLY)
+    
+    # Use passed region_name instead of parsing from URL
+    region_name = region_name.strip()
+    
+    for bird_row in soup.find_all('tr', class_='highlight1'):
+        name = bird_row.td.text
+        rarity = next((text.rstrip() for text in bird_row.td.next_sibling.next_sibling.contents 
+                      if isinstance(text, str) and text.strip()), 'Common')
         
-        for bird_row in soup.find_all('tr', class_='highlight1'):
-            name = bird_row.td.text
-            rarity = next((text.rstrip() for text in bird_row.td.next_sibling.next_sibling.contents 
-                          if isinstance(text, str) and text.strip()), 'Common')
-            
-            if (breeding := bird_row.find('font', color='blue')):
-                rarity = breeding.text
-
-            tag = f'UB::{country_name}::{region_name}::{rarity}'
-            tag = tag.replace(' ', '-') + ' '
+        if (breeding := bird_row.find('font', color='blue')):
+            rarity = breeding.text
 
-            if rarity == 'Extirpated':
-                tag = ''
-            
-            mask = df['English (Clements)'] == name
-            df.loc[mask, 'TAGS'] = df.loc[mask, 'TAGS'] + tag
+        tag = f'UB::{country_name}::{region_name}::{rarity}'
+        tag = tag.replace(' ', '-') + ' '
 
-    except RequestException as e:
-        print(f"Request error for {region_url}: {str(e)}")
+        if rarity == 'Extirpated':
+            tag = ''
+        
+        birds.append((name, tag))
 
+    return birds
 
-def scrape_country(df, soup, country):
-    """Scrape bird data for a country and update the DataFrame."""
+def scrape_country(soup, country, base_url=BASE_URL_AVIBASE):
+    """Scrape bird data for a country and return its (name, tag, avibase_url, conservation_status) rows."""
+    birds = []
     bird_rows = soup.find_all('tr', class_='highlight1')
 
     for bird_row in bird_rows:
         name = bird_row.td.text
-        avibase_url = BASE_URL_AVIBASE + bird_row.td.next_sibling.a['href']
+        avibase_url = base_url + bird_row.td.next_sibling.a['href']
         rarity_cons_stat = bird_row.td.next_sibling.next_sibling.contents
 
         rarity = ''
@@ -111,44 +167,13 @@ def scrape_country(df, soup, country):
         conservation_status = bird_row.find('font', color='red')
         conservation_status = conservation_status.text if conservation_status else "Least concern"
 
-        # Update DataFrame with scraped tags
-        row = df['English (Clements)'] == name
-        df.loc[row, 'TAGS'] = df.loc[row, 'TAGS'] + tag
-        if df.loc[row, 'AVIBASE'].array and pd.isnull(df.loc[row, 'AVIBASE'].array[0]):
-            df.loc[row, 'AVIBASE'] = avibase_url
-            df.loc[row, 'CONS_STATUS'] = conservation_status
+        birds.append((name, tag, avibase_url, conservation_status))
 
+    return birds
 
-def process_country(df, a_tag):
-    """Process a country and its regions."""
-    try:
-        # Scrape country data
-        country_url = BASE_URL_AVIBASE + a_tag['href']
-        country_name = a_tag.text
-
-        # Country-level scraping
-        response = fetch_url(country_url)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'lxml')
-            scrape_country(df, soup, country_name)
-        
-        # Modified region processing section
-        if country_name in DIVERSE_COUNTRIES:
-            region_driver = initialize_webdriver()
-            region_links = fetch_country_regions(region_driver, country_name)
-            region_driver.quit()
-
-            # Loop through each region link sequentially
-            for link in region_links:
-                scrape_region_data(
-                    df, 
-                    BASE_URL_AVIBASE + link['href'],  # Construct full URL
-                    country_name,
-                    link.text  # Pass region name from <a> tag text
-                )
-
-    except Exception as e:
-        print(f"Error processing {country_name}: {str(e)}")
+def parse_country_page(content, country, base_url):
+    """The bird rows of a country's checklist page, see scrape_country."""
+    return scrape_country(BeautifulSoup(content, 'lxml', parse_only=BIRDS_PARSE_ONLY), country, base_url)
 
 
 def scrape_avibase_data(df_base):
@@ -158,25 +183,80 @@ def scrape_avibase_data(df_base):
     """
     print('-------- Starting Avibase scraping --------')
     df = df_base[['Scientific (Clements)', 'English (Clements)']].copy()
-    df['TAGS'] = ''
-    for col in ['AVIBASE', 'CONS_STATUS']:
-        df[col] = pd.NA
-    
-    # Initialize main driver for country list
-    main_driver = initialize_webdriver()
-    main_driver.get(BASE_URL_AVIBASE + 'checklist.jsp?lang=EN')
-    
-    try:
-        WebDriverWait(main_driver, 10).until(
-            EC.presence_of_element_located((By.CLASS_NAME, 'reg3'))
-        )
-        country_links = BeautifulSoup(main_driver.page_source, 'lxml').find_all('tr', class_='reg3')
-    finally:
-        main_driver.quit()
+    results = AvibaseResults()
+
+    # Resume from the journal of an interrupted run, pages that were scraped before are not fetched again.
+    journal = Journal('avibase')
+    completed = journal.completed()
+    if completed:
+        print(f"Resuming: {len(completed)} pages already scraped")
+
+    # Each country has its checklist page and, for the most diverse ones, a page listing their regions.
+    countries = []
+    for country_row in fetch_country_list():
+        name = country_row.td.a.text
+        country_url = BASE_URL_AVIBASE + country_row.td.a['href']
+        regions_url = None
+        if name in DIVERSE_COUNTRIES and not USE_SELENIUM and country_url not in completed:
+            regions_url = region_list_url(country_row, name)
+        countries.append((name, country_url, regions_url))
+    pending = [country for country in countries if country[1] not in completed]
+
+    region_links = {}
+    if USE_SELENIUM:
+        diverse = [name for name, _, _ in pending if name in DIVERSE_COUNTRIES]
+        region_links = dict(zip(diverse, map_concurrent(fetch_region_links_selenium, diverse, desc="Expanding regions")))
+
+    def record_country(name, country_url, regions_url):
+        birds = pages[country_url]
+        links = pages.get(regions_url) if regions_url else region_links.get(name, [])
+        regions = [(BASE_URL_AVIBASE + href, name, region_name) for href, region_name in links or []]
+        # Without its list of regions the country's region tags would be missing, so it is retried like a failed checklist.
+        if birds is None or links is None:
+            journal.record_failure(country_url)
+            completed[country_url] = [birds or [], regions]
+        else:
+            journal.record(country_url, [birds, regions])
+            completed[country_url] = [birds, regions]
+
+    # Pages are fetched concurrently (fetch_url throttles the requests to Avibase) and parsed in other processes.
+    # A country is recorded as soon as both of its pages are in.
+    jobs = [(country_url, parse_country_page, (name, BASE_URL_AVIBASE)) for name, country_url, _ in pending]
+    jobs += [(regions_url, parse_region_links, (name,)) for name, _, regions_url in pending if regions_url]
+    country_of = {url: country for country in pending for url in country[1:] if url}
+    pages = {}
+    for url, result in fetch_and_parse(jobs, desc="Processing countries"):
+        pages[url] = result
+        name, country_url, regions_url = country_of[url]
+        if country_url in pages and (regions_url is None or regions_url in pages):
+            record_country(name, country_url, regions_url)
+
+    # Then all regions of every country.
+    regions = [region for name, country_url, _ in countries for region in completed[country_url][1]]
+    jobs = [(region_url, parse_region_page, (country_name, region_name))
+            for region_url, country_name, region_name in regions if region_url not in completed]
+    for url, birds in fetch_and_parse(jobs, desc="Processing regions"):
+        if birds is None:
+            journal.record_failure(url)
+        else:
+            journal.record(url, birds)
+        completed[url] = birds or []
 
-    for link in tqdm(country_links, desc="Processing countries"):
-        process_country(df, link.td.a)
+    # Collect the results in page order so every species gets its tags in the same order as a sequential run.
+    for _, country_url, _ in countries:
+        birds, country_regions = completed[country_url]
+        for name, tag, avibase_url, conservation_status in birds:
+            results.add_tag(name, tag)
+            results.add_details(name, avibase_url, conservation_status)
+        for region_url, _, _ in country_regions:
+            for name, tag in completed[region_url]:
+                results.add_tag(name, tag)
     
     # Save final data
+    df = results.apply(df)
     df = df.drop(columns=['English (Clements)'])
-    df.to_csv(PROCESSED_FILES['avibase'], index=False)
\ No newline at end of file
+    count('rows_processed_total', len(df))
+    with timed_io('write', PROCESSED_FILES['avibase']):
+        df.to_csv(PROCESSED_FILES['avibase'], index=False)
+    save_to_store('avibase')
+    finish_journal(journal)
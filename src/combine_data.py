@@ -1,15 +1,40 @@
-from file_paths import INPUT_FILES, PROCESSED_FILES, OUTPUT_FILES
+from file_paths import INPUT_FILES, OUTPUT_FILES
+from store import SpeciesStore
+from media import localize_media
+from metrics import count, timer, timed_io
+from importlib.util import find_spec
+from contextlib import ExitStack
 import pandas as pd
+import gzip
 import csv
+import os
 
-def create_csv(df):
-    with open(OUTPUT_FILES['output'], 'w', encoding='utf-8', newline='') as f:
-        # File header for Anki
-        f.write(f'#separator:Comma\n#html:true\n#notetype:Birds\n#deck:Ultimate Birds\n#tags column:{list(df.columns).index("Tags") + 1}\n#columns:{",".join(df.columns)}\n')
-        
-        df.to_csv(f, index=False, header=False)
+# The image and sound HTML make up most of the data. With pyarrow they are kept in contiguous
+# Arrow buffers instead of one Python string per cell.
+HTML_COLUMNS = ['IMAGES', 'SOUNDS']
+HTML_DTYPE = 'string[pyarrow]' if find_spec('pyarrow') else object
+
+def load_species(df):
+    """
+    The rows of the deck, joined with all processed data by the species_wide view of the store (see store.py).
+    The species of df are loaded into the store first, together with every processed file that changed.
+    """
+    store = SpeciesStore()
+    try:
+        with timer('io_seconds', operation='read', file='processed files'):
+            store.sync()
+            store.load_base(df)
+        with timer('merge_seconds', step='species_wide'):
+            df = store.read_wide()
+    finally:
+        store.close()
+    return df.astype({column: HTML_DTYPE for column in HTML_COLUMNS})
 
 def update_notes(df, notes_file):
+    """
+    Find the notes from the previous version of the deck that each row updates.
+    Returns the unique note IDs, indexed like the matched rows of df.
+    """
     notes = pd.read_csv(notes_file, sep='\t', skiprows=6, header=None, dtype=str, encoding='UTF-8')
     
     # Correct column indices for the notes file
@@ -18,79 +43,87 @@ def update_notes(df, notes_file):
     scientific_col = 4 # Scientific name column
     ebird_url_col = 10  # eBird URL column
     
-    # Create dictionaries to map values to unique IDs (first occurrence)
-    ebird_url_to_id = {}
-    english_to_id = {}
-    scientific_to_id = {}
-    
-    for _, row in notes.iterrows():
-        uid = row[unique_id_col]
-        ebird_url = row[ebird_url_col] if pd.notna(row[ebird_url_col]) else None
-        english = row[english_col] if pd.notna(row[english_col]) else None
-        scientific = row[scientific_col] if pd.notna(row[scientific_col]) else None
-        
-        # Populate eBird URL dictionary
-        if ebird_url and ebird_url not in ebird_url_to_id:
-            ebird_url_to_id[ebird_url] = uid
-        # Populate English dictionary
-        if english and english not in english_to_id:
-            english_to_id[english] = uid
-        # Populate Scientific dictionary
-        if scientific and scientific not in scientific_to_id:
-            scientific_to_id[scientific] = uid
-    
-    # Prepare to collect unique IDs for the new df
-    unique_ids = []
-    rows_to_keep = []
-    
-    # Iterate over each row in df to check for matches
-    for idx, row in df.iterrows():
-        current_ebird = row.get('eBird URL', '')
-        current_english = row.get('English', '')
-        current_scientific = row.get('Scientific', '')
-        matched_id = None
-        
-        # Check eBird URL first
-        if current_ebird in ebird_url_to_id:
-            matched_id = ebird_url_to_id[current_ebird]
-        else:
-            # Check English name
-            if current_english in english_to_id:
-                matched_id = english_to_id[current_english]
-            else:
-                # Check Scientific name
-                if current_scientific in scientific_to_id:
-                    matched_id = scientific_to_id[current_scientific]
-        
-        if matched_id:
-            unique_ids.append(matched_id)
-            rows_to_keep.append(idx)
-    
-    # Filter the df to keep only matched rows and add the unique ID column
-    df = df.loc[rows_to_keep].copy()
-    df.insert(0, 'Unique ID', unique_ids)
+    # Match every row on eBird URL first, then English name, then Scientific name,
+    # using the unique ID of the first note with that value.
+    unique_ids = pd.Series(pd.NA, index=df.index, dtype=object)
+    matched = pd.Series(False, index=df.index)
+    for column, notes_col in [('eBird URL', ebird_url_col), ('English', english_col), ('Scientific', scientific_col)]:
+        first_notes = notes.dropna(subset=[notes_col]).drop_duplicates(subset=notes_col)
+        value_to_id = pd.Series(first_notes[unique_id_col].values, index=first_notes[notes_col].values)
+        found = ~matched & df[column].isin(value_to_id.index)
+        unique_ids[found] = df.loc[found, column].map(value_to_id)
+        matched |= found
+    unique_ids = unique_ids[matched]
 
     # Remove splits (they will be added as newly created notes from different file)
-    df = df[~df['Unique ID'].duplicated(keep=False)]
+    return unique_ids[~unique_ids.duplicated(keep=False)]
+
+def anki_header(columns, guid=False):
+    """File header for Anki"""
+    guid_line = '#guid column:1\n' if guid else ''
+    return f'#separator:Comma\n{guid_line}#html:true\n#notetype:Birds\n#deck:Ultimate Birds\n#tags column:{list(columns).index("Tags") + 1}\n#columns:{",".join(columns)}\n'
 
+class Tee:
+    """File-like object that writes everything to several files, so a row is serialized once for all of them."""
+    def __init__(self, *files):
+        self.files = files
 
-    with open(OUTPUT_FILES['output_notes'], 'w', encoding='utf-8', newline='') as f:
-        # File header for Anki
-        f.write(f'#separator:Comma\n#guid column:1\n#html:true\n#notetype:Birds\n#deck:Ultimate Birds\n#tags column:{list(df.columns).index("Tags") + 1}\n#columns:{",".join(df.columns)}\n')
-        
+    def write(self, text):
+        for f in self.files:
+            f.write(text)
+
+EXPORT_BUFFER_SIZE = 1024 * 1024
+
+def export_anki(df, unique_ids, gzip_sidecar=False):
+    """
+    Write the three output files in a single pass over the rows:
+      - OUTPUT_FILES['output_header']: plain CSV with a header row
+      - OUTPUT_FILES['output']: the same rows with the Anki file header, to import as new notes
+      - OUTPUT_FILES['output_notes']: the rows that update an existing note, with its unique ID as GUID
+    With gzip_sidecar, a gzip'd copy of OUTPUT_FILES['output'] is written next to it.
+    Cells are formatted the way DataFrame.to_csv formats them, so the files are unchanged.
+    """
+    columns = list(df.columns)
+    notes_columns = ['Unique ID'] + columns
+
+    with ExitStack() as stack:
+        open_output = lambda path: stack.enter_context(open(path, 'w', encoding='utf-8', newline='', buffering=EXPORT_BUFFER_SIZE))
+        header_file = open_output(OUTPUT_FILES['output_header'])
+        output_files = [open_output(OUTPUT_FILES['output'])]
+        if gzip_sidecar:
+            output_files.append(stack.enter_context(gzip.open(OUTPUT_FILES['output'] + '.gz', 'wt', encoding='utf-8', newline='')))
+        output = Tee(*output_files)
+        notes_file = open_output(OUTPUT_FILES['output_notes'])
+
+        csv.writer(header_file, lineterminator=os.linesep).writerow(columns)
+        output.write(anki_header(columns))
+        notes_file.write(anki_header(notes_columns, guid=True))
+
+        rows = csv.writer(Tee(header_file, output), lineterminator=os.linesep)
         # Add quotes to avoid skipping if the GUID begins with "#"
-        df.to_csv(f, index=False, header=False, quoting=csv.QUOTE_STRINGS)
+        notes = csv.writer(notes_file, lineterminator=os.linesep, quoting=csv.QUOTE_STRINGS)
 
+        # Missing values are written as empty strings and numbers stay numbers, like DataFrame.to_csv does.
+        values = df.astype(object).where(df.notna(), '')
+        is_note = df.index.isin(unique_ids.index)
+        note_ids = iter(unique_ids.reindex(df.index[is_note]))
+        for row, note in zip(values.itertuples(index=False, name=None), is_note):
+            rows.writerow(row)
+            if note:
+                notes.writerow((next(note_ids),) + row)
 
-def combine_data(df, version_tag):
+
+def combine_data(df, version_tag, gzip_sidecar=False):
     """
     Combine all processed data into a single DataFrame.
     """
     print("-------- Combining data --------")
     
-    # Merge all processed files
-    for file in PROCESSED_FILES.values():
-        df = pd.merge(df, pd.read_csv(file, na_values=['']), on='Scientific (Clements)', how="left")
+    # All processed data is joined in the store instead of merging the files in pandas
+    df = load_species(df)
+
+    # Link to the packaged media instead of the online files, when they were packaged.
+    localize_media(df, HTML_COLUMNS, OUTPUT_FILES['media_files'])
     
     df = df.rename(columns={
         'English (Clements)': 'English',
@@ -118,9 +151,11 @@ def combine_data(df, version_tag):
     # Add version tag
     df['Tags'] = df['Tags'] + f'UB::{version_tag}'
 
-    # Save the data as CSV with and without file header
-    df.to_csv(OUTPUT_FILES['output_header'], index=False)
-    create_csv(df)
+    # Update notes from the previous version of the deck with their unique note ids
+    with timer('merge_seconds', step='notes'):
+        unique_ids = update_notes(df, INPUT_FILES['notes'])
 
-    # Update notes from the previous version of the deck and save with unique note ids
-    update_notes(df, INPUT_FILES['notes'])
\ No newline at end of file
+    # Save the data as CSV with and without file header, and the notes to update
+    count('rows_processed_total', len(df))
+    with timed_io('write', OUTPUT_FILES['output']):
+        export_anki(df, unique_ids, gzip_sidecar)
\ No newline at end of file
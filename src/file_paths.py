@@ -7,11 +7,13 @@ INPUT_FILES = {
     "audio_files": "data/input/wildlife-sounds-birds-20250207.dwca/Multimedia.txt",
     "audio_data": "data/input/wildlife-sounds-birds-20250207.dwca/Occurrence.txt",
     "notes": "data/input/Ultimate Birds.txt",
+    "previous_base_data": "data/input/base_data - old version.csv",
+    "previous_taxonomy": "data/input/eBird_Taxonomy_v2023.csv",
 }
 
 PROCESSED_FILES = {
     "avibase": "data/processed/avibase.csv",
-    "translations": "data/processed/translations.csv",
+    "translations": "data/processed/translations.csv.gz",
     "mnemonics": "data/processed/mnemonics.csv",
     "images": "data/processed/images.csv",
     "audio": "data/processed/audio.csv",
@@ -22,4 +24,19 @@ OUTPUT_FILES = {
     "output_header": "data/output/Ultimate Birds_header.csv",
     "output_notes": "data/output/Ultimate Birds_notes.txt",
     "base_data": "data/output/base_data.csv",
-}
\ No newline at end of file
+    "taxonomy_diff": "data/output/taxonomy_diff.csv",
+    "media": "data/output/collection.media",
+    "media_manifest": "data/output/media_manifest.csv",
+    "media_files": "data/output/media_files.csv",
+}
+
+CACHE_FILES = {
+    "http": "data/cache/http",
+    "audio": "data/cache/audio",
+    "excel": "data/cache/excel",
+    "pipeline": "data/cache/pipeline.json",
+    "journal": "data/cache/journal.sqlite",
+    "media": "data/cache/media",
+    "transcode": "data/cache/transcode",
+    "store": "data/cache/species.sqlite",
+}
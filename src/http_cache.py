@@ -0,0 +1,162 @@
+from requests.structures import CaseInsensitiveDict
+from file_paths import CACHE_FILES
+import requests
+import threading
+import hashlib
+import sqlite3
+import time
+import zlib
+import os
+
+"""
+Persistent response cache for fetch_url.
+
+Bodies are stored zlib-compressed under the SHA-256 of their content, so identical pages
+are only stored once. An SQLite index maps each URL to its body together with the
+ETag/Last-Modified validators used for conditional requests.
+"""
+CACHE_TTL = 7 * 24 * 60 * 60  # Seconds before a cached response is revalidated with the server
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # Least recently used responses are evicted above this size
+OFFLINE = False  # Serve only from the cache and never touch the network, set by --offline
+
+class CachedResponse:
+    def __init__(self, url, digest, etag, last_modified, content_type, fetched_at, body):
+        self.url = url
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.fetched_at = fetched_at
+        self.body = body
+
+    def is_fresh(self):
+        return time.time() - self.fetched_at < CACHE_TTL
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def to_response(self):
+        """Rebuild a requests.Response so callers can't tell a cache hit from a download."""
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = self.url
+        response._content = self.body
+        response.headers = CaseInsensitiveDict({'Content-Type': self.content_type} if self.content_type else {})
+        return response
+
+
+class ResponseCache:
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes if max_bytes is not None else CACHE_MAX_BYTES
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_type TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_digest ON responses (digest)')
+        self.db.commit()
+        self.total_size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM responses)').fetchone()[0]
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest[2:] + '.zlib')
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT digest, etag, last_modified, content_type, fetched_at FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            digest, etag, last_modified, content_type, fetched_at = row
+            try:
+                with open(self.object_path(digest), 'rb') as f:
+                    body = zlib.decompress(f.read())
+            except (OSError, zlib.error):
+                # The body went missing or is corrupt, treat it as a miss so it's downloaded again.
+                self._delete(url, digest)
+                self.db.commit()
+                return None
+            self.db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?', (time.time(), url))
+            self.db.commit()
+        return CachedResponse(url, digest, etag, last_modified, content_type, fetched_at, body)
+
+    def put(self, url, response):
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        now = time.time()
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write to a temporary file first so an interrupted run never leaves a truncated body behind.
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(zlib.compress(body))
+                os.replace(tmp_path, path)
+                self.total_size += os.path.getsize(path)
+            old = self.db.execute('SELECT digest FROM responses WHERE url = ?', (url,)).fetchone()
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, digest, os.path.getsize(path), response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                 response.headers.get('Content-Type'), now, now)
+            )
+            if old and old[0] != digest:
+                self._remove_unreferenced(old[0])
+            self._evict()
+            self.db.commit()
+
+    def touch(self, url):
+        """Mark a cached response as fresh after the server answered 304 Not Modified."""
+        with self.lock:
+            now = time.time()
+            self.db.execute('UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+            self.db.commit()
+
+    def _delete(self, url, digest):
+        self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+        self._remove_unreferenced(digest)
+
+    def _remove_unreferenced(self, digest):
+        if self.db.execute('SELECT 1 FROM responses WHERE digest = ? LIMIT 1', (digest,)).fetchone():
+            return
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            self.total_size -= os.path.getsize(path)
+            os.remove(path)
+
+    def _evict(self):
+        while self.total_size > self.max_bytes:
+            row = self.db.execute('SELECT url, digest FROM responses ORDER BY accessed_at LIMIT 1').fetchone()
+            if row is None:
+                break
+            self._delete(*row)
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(CACHE_FILES['http'])
+        return _response_cache
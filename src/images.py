@@ -1,29 +1,35 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+import pandas as pd
 from file_paths import PROCESSED_FILES
-from utils import fetch_url
-from tqdm import tqdm
+from utils import fetch_and_parse, has_class
+from journal import Journal, finish_journal
+from taxonomy_diff import split_unchanged, with_reused
+from store import SpeciesStore, save_to_store
+from metrics import count, timed_io
 
-def scrape_images_for_species(df, idx):
+# Only the image container and the identification text are built into a tree, the rest of the page is skipped.
+SPECIES_PAGE_PARSE_ONLY = SoupStrainer(['div', 'p'], class_=has_class('Hero-image', 'u-stack-sm'))
+
+def parse_species_page(content, url):
     """
-    Scrape images for a single species from its EBIRD page and update the DataFrame.
+    Get the images and identification text from the HTML of an EBIRD species page.
     
     Args:
-        df (pd.DataFrame): The DataFrame containing species information.
-        idx (int): The index of the species to process.
-    """
-    url = df.loc[idx, 'EBIRD']
-    
-    response = fetch_url(url)
-    if not response:
-        return
+        content (bytes): The HTML of the page.
+        url (str): The eBird species page, for messages.
 
-    soup = BeautifulSoup(response.content, "html.parser")
+    Returns:
+        list: The Anki HTML for the images and the identification text,
+              both empty if the page has no images.
+    """
+    soup = BeautifulSoup(content, "html.parser", parse_only=SPECIES_PAGE_PARSE_ONLY)
     
     # Find the container with the images.
     img_container = soup.find('div', class_='Hero-image')
     if not img_container:
+        # Species without photos are scraped fine, only pages that could not be fetched or parsed are failures.
         print(f"No image container found on page: {url}")
-        return
+        return ['', '']
 
     anki_imgs = ""
     
@@ -73,21 +79,50 @@ def scrape_images_for_species(df, idx):
     identification = identification.text if identification else ""
     soup.decompose()
 
-    # Update the DataFrame safely.
-    df.loc[idx, 'IMAGES'] = anki_imgs
-    df.loc[idx, 'DESC'] = identification
+    return [anki_imgs, identification]
 
-def scrape_images(base_df):
+def scrape_images(base_df, incremental=False):
     """
     Scrape images for all species listed in the input CSV file and write the results to an output CSV.
+    With incremental set, only species that changed since the previous version are scraped (see taxonomy_diff.py).
     """
     print("-------- Scraping Images --------")
     df = base_df[['Scientific (Clements)', 'EBIRD']].copy()
+    reused = None
+    if incremental:
+        df, reused = split_unchanged(df, PROCESSED_FILES['images'])
 
-    # Process each species one at a time to avoid overloading the site.
-    for idx in tqdm(df.index, desc="Scraping images"):
-        scrape_images_for_species(df, idx)
+    # Resume from the journal of an interrupted run, only species that are missing or failed are scraped again.
+    journal = Journal('images')
+    completed = journal.completed()
+    urls = [url for url in df['EBIRD'].drop_duplicates() if url not in completed]
+    if completed:
+        print(f"Resuming: {len(completed)} species already scraped, {len(urls)} to go")
 
-    df.drop(columns=['EBIRD'], inplace=True)
-    
-    df.to_csv(PROCESSED_FILES['images'], index=False)
+    # Species are fetched concurrently (fetch_url throttles each host to avoid overloading the site)
+    # and their pages are parsed in other processes while the next ones download.
+    # Every species is upserted into the store as soon as it is scraped, so it can be looked up before the stage is done.
+    store = SpeciesStore()
+    species = df.groupby('EBIRD')['Scientific (Clements)'].agg(list)
+    jobs = [(url, parse_species_page, (url,)) for url in urls]
+    for url, result in fetch_and_parse(jobs, desc="Scraping images"):
+        if result is None:
+            journal.record_failure(url)
+        else:
+            journal.record(url, result)
+            store.upsert('images', pd.DataFrame([[name, *result] for name in species[url]], columns=['Scientific (Clements)', 'IMAGES', 'DESC']))
+    journal.flush()
+    store.close()
+
+    # Build the results from the journal.
+    completed = journal.completed()
+    df['IMAGES'] = df['EBIRD'].map(lambda url: completed[url][0] if url in completed else None)
+    df['DESC'] = df['EBIRD'].map(lambda url: completed[url][1] if url in completed else None)
+
+    df = with_reused(df.drop(columns=['EBIRD']), reused, base_df['Scientific (Clements)'])
+
+    count('rows_processed_total', len(df))
+    with timed_io('write', PROCESSED_FILES['images']):
+        df.to_csv(PROCESSED_FILES['images'], index=False)
+    save_to_store('images')
+    finish_journal(journal)
@@ -0,0 +1,118 @@
+from file_paths import OUTPUT_FILES, CACHE_FILES
+from utils import file_hash
+import threading
+import sqlite3
+import json
+import time
+import os
+
+"""
+Progress journal for the scrapers.
+
+Every scraped species or page is appended with its result as soon as it is done, so a run that dies
+halfway can be restarted and only fetches what is missing or failed. Writes are committed (and synced
+to disk) in batches of JOURNAL_BATCH_SIZE entries or every JOURNAL_FLUSH_SECONDS, whichever comes first.
+
+The progress belongs to the version of the base data it was scraped for: when base_data.csv changed since, the
+stage's entries are dropped when the journal is opened, so a journal that was kept for its failures doesn't hold
+on to the results of an old version. Entries older than JOURNAL_MAX_AGE_DAYS are dropped all the same.
+"""
+JOURNAL_BATCH_SIZE = 100
+JOURNAL_FLUSH_SECONDS = 10
+JOURNAL_MAX_AGE_DAYS = 30  # Set by --journal-max-age
+
+def base_data_version():
+    return file_hash(OUTPUT_FILES['base_data']) if os.path.exists(OUTPUT_FILES['base_data']) else ''
+
+class Journal:
+    def __init__(self, stage, path=None, version=None, max_age_days=None):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+        path = path or CACHE_FILES['journal']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                stage TEXT NOT NULL,
+                key TEXT NOT NULL,
+                ok INTEGER NOT NULL,
+                result TEXT,
+                recorded_at REAL NOT NULL,
+                PRIMARY KEY (stage, key)
+            )''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS versions (stage TEXT PRIMARY KEY, version TEXT NOT NULL)')
+        self.expire(base_data_version() if version is None else version,
+                    JOURNAL_MAX_AGE_DAYS if max_age_days is None else max_age_days)
+        self.db.commit()
+
+    def expire(self, version, max_age_days):
+        """Drop the entries of another version of the base data, and the ones older than max_age_days."""
+        previous = self.db.execute('SELECT version FROM versions WHERE stage = ?', (self.stage,)).fetchone()
+        if previous and previous[0] != version:
+            dropped = self.db.execute('DELETE FROM entries WHERE stage = ?', (self.stage,)).rowcount
+            if dropped:
+                print(f"The base data changed since the journal of {self.stage} was written, dropped its {dropped} entries")
+        self.db.execute('INSERT OR REPLACE INTO versions VALUES (?, ?)', (self.stage, version))
+
+        expired = self.db.execute('DELETE FROM entries WHERE stage = ? AND recorded_at < ?',
+                                  (self.stage, time.time() - max_age_days * 24 * 60 * 60)).rowcount
+        if expired:
+            print(f"Dropped {expired} journal entries of {self.stage} older than {max_age_days} days")
+
+    def completed(self):
+        """Results of everything that was scraped successfully, by key."""
+        with self.lock:
+            rows = self.db.execute('SELECT key, result FROM entries WHERE stage = ? AND ok = 1', (self.stage,)).fetchall()
+        return {key: json.loads(result) for key, result in rows}
+
+    def failed(self):
+        with self.lock:
+            rows = self.db.execute('SELECT key FROM entries WHERE stage = ? AND ok = 0', (self.stage,)).fetchall()
+        return [key for key, in rows]
+
+    def record(self, key, result):
+        self._write(key, True, json.dumps(result))
+
+    def record_failure(self, key):
+        self._write(key, False, None)
+
+    def _write(self, key, ok, result):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (self.stage, key, int(ok), result, time.time()))
+            self.pending += 1
+            if self.pending >= JOURNAL_BATCH_SIZE or time.monotonic() - self.last_flush >= JOURNAL_FLUSH_SECONDS:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.db.commit()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def clear(self):
+        """Forget the stage's progress once its results are saved, so the next run starts fresh."""
+        with self.lock:
+            self.db.execute('DELETE FROM entries WHERE stage = ?', (self.stage,))
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def finish_journal(journal):
+    """Clear the journal after a complete run, or keep it so the next run only retries what failed."""
+    failed = journal.failed()
+    if failed:
+        print(f"{len(failed)} pages failed for {journal.stage}, run it again to retry only those")
+        journal.flush()
+    else:
+        journal.clear()
@@ -1,24 +1,68 @@
-from base_data import get_base_data
-from translations import merge_translations
-from mnemonics import process_mnemonics
-from avibase import scrape_avibase_data
-from images import scrape_images
-from audio import get_audio
-from combine_data import combine_data
+from pipeline import Pipeline, STAGES
+from metrics import write_metrics
+import http_cache
+import journal
+import argparse
+import sys
+
+VERSION_TAG = 'version-2025-03-08'
 
 def main():
-    df = get_base_data()
+    parser = argparse.ArgumentParser(description='Build the Ultimate Birds deck. Stages that are up to date are skipped.')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f'Stages to rebuild even if they are up to date: {", ".join(STAGES)}. '
+                             'Stages they depend on only run when out of date. Without stages, everything out of date is built.')
+    parser.add_argument('--all', action='store_true', help='Rebuild every stage')
+    parser.add_argument('--no-deps', action='store_true', help='Only run the given stages, the stages they depend on only run when their outputs are missing')
+    parser.add_argument('--version-tag', default=VERSION_TAG, help='Tag added to every note')
+    parser.add_argument('--jobs', type=int, help='Maximum number of stages running at the same time')
+    parser.add_argument('--streaming', action='store_true', help='Read the audio archive in chunks')
+    parser.add_argument('--gzip', action='store_true', help="Also write a gzip'd copy of the deck CSV")
+    parser.add_argument('--incremental', action='store_true', help='Only scrape images and select audio for species that changed since the previous version (see taxonomy_diff.py), reusing their previous rows for the rest')
+    parser.add_argument('--package-media', action='store_true', help='Download the images and sounds into data/output/collection.media and link the deck to those files, so it works offline')
+    parser.add_argument('--transcode-images', choices=['webp', 'avif'], help='With --package-media, convert the images and spectrograms to this format (needs Pillow)')
+    parser.add_argument('--image-width', type=int, help='Maximum width of transcoded images (default 640)')
+    parser.add_argument('--image-quality', type=int, help='Quality of transcoded images, 0-100 (default 75)')
+    parser.add_argument('--transcode-audio', choices=['opus', 'mp3'], help='With --package-media, re-encode the recordings to this format (needs ffmpeg)')
+    parser.add_argument('--audio-bitrate', help='Bitrate of re-encoded recordings (default 64k)')
+    parser.add_argument('--offline', action='store_true', help='Only use responses from the HTTP cache and never touch the network, pages that are not cached fail')
+    parser.add_argument('--journal-max-age', type=float, metavar='DAYS', help='Drop the progress of interrupted scrapes older than DAYS (default 30); progress is always dropped when the base data changed')
+    parser.add_argument('--dry-run', action='store_true', help='Only show which stages would run')
+    parser.add_argument('--metrics', metavar='PATH', help='Write timers, counters and histograms per stage to PATH, as JSON if it ends in .json and in the Prometheus text format otherwise')
+    parser.add_argument('--profile', metavar='DIR', help='Profile every stage that runs into DIR (pyinstrument if installed, else cProfile). Stages then run one at a time')
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage {stage!r}, choose from {", ".join(STAGES)}')
+    if args.offline:
+        http_cache.OFFLINE = True
+    if args.journal_max_age is not None:
+        journal.JOURNAL_MAX_AGE_DAYS = args.journal_max_age
 
-    # Optionally run independent processes in any order
-    # merge_translations(df)
-    # process_mnemonics(df)
-    # scrape_avibase_data(df)
-    # scrape_images(df)
-    # get_audio(df)
-    
-    # Combine results
-    combine_data(df, 'version-2025-03-08')
+    pipeline = Pipeline({
+        'version_tag': args.version_tag,
+        'streaming': args.streaming,
+        'gzip': args.gzip,
+        'incremental': args.incremental,
+        'package_media': args.package_media,
+        'transcode_images': args.transcode_images,
+        'image_width': args.image_width,
+        'image_quality': args.image_quality,
+        'transcode_audio': args.transcode_audio,
+        'audio_bitrate': args.audio_bitrate,
+        'profile': args.profile,
+    })
+    force = set(STAGES) if args.all else set(args.stages)
+    # Only one profiler can be active at a time.
+    jobs = 1 if args.profile else args.jobs
+    try:
+        succeeded = pipeline.run(args.stages or None, force=force, jobs=jobs, dry_run=args.dry_run, no_deps=args.no_deps)
+    finally:
+        if args.metrics:
+            write_metrics(args.metrics)
+    if not succeeded:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
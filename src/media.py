@@ -0,0 +1,140 @@
+import pandas as pd
+import mimetypes
+import hashlib
+import os
+from urllib.parse import urlparse
+from file_paths import PROCESSED_FILES, OUTPUT_FILES, CACHE_FILES
+from utils import fetch_url, map_concurrent
+from journal import Journal, finish_journal
+from metrics import count, timed_io
+
+"""
+Package the images, recordings and spectrograms the deck links to, so cards work offline.
+
+Every file in the src attributes of the processed images and audio is downloaded once, with a bounded number
+of concurrent requests, into CACHE_FILES['media'] under a name derived from the SHA-256 of its content.
+URLs with the same content share one file, and a file keeps its name from one build to the next.
+The manifest maps each URL to its kind of media and its file, URLs whose file is still there are not downloaded again.
+The transcode stage builds the deck's media folder from these files (see transcode.py), and combine_data
+points the src attributes at the files in that folder with localize_media.
+"""
+MEDIA_COLUMNS = {PROCESSED_FILES['images']: 'IMAGES', PROCESSED_FILES['audio']: 'SOUNDS'}
+MANIFEST_COLUMNS = ['url', 'kind', 'file', 'sha256', 'bytes']
+# The tag and src of every file: the images are the <img> tags of IMAGES, the recordings the <source> tags
+# of SOUNDS and their spectrograms its <img> tags.
+SRC_PATTERN = r'<(\w+)\s[^>]*?src="(https?://[^"]+)"'
+MEDIA_KINDS = {('IMAGES', 'img'): 'image', ('SOUNDS', 'source'): 'audio', ('SOUNDS', 'audio'): 'audio', ('SOUNDS', 'img'): 'spectrogram'}
+# The src of a <source> tag is followed by the type of the file.
+LOCALIZE_PATTERN = r'src="(https?://[^"]+)"( type="[^"]*")?'
+MEDIA_PREFIX = 'ub_'
+# Asset URLs don't end in an extension, so it is taken from the content type.
+EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp', 'image/avif': '.avif', 'image/gif': '.gif',
+              'audio/mpeg': '.mp3', 'audio/mp3': '.mp3', 'audio/ogg': '.ogg', 'audio/wav': '.wav'}
+
+def media_urls():
+    """Every URL in the src attributes of the processed images and audio with its kind of media, in the order they first appear."""
+    urls = {}
+    for file, column in MEDIA_COLUMNS.items():
+        with timed_io('read', file):
+            html = pd.read_csv(file, usecols=[column])[column].dropna()
+        for tag, url in html.str.findall(SRC_PATTERN).explode().dropna():
+            urls.setdefault(url, MEDIA_KINDS.get((column, tag), 'other'))
+    return urls
+
+def media_extension(url, response):
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type in EXTENSIONS:
+        return EXTENSIONS[content_type]
+    return os.path.splitext(urlparse(url).path)[1] or mimetypes.guess_extension(content_type) or ''
+
+def store_media(url, content, extension):
+    """Save the content under its hashed name, unless a file with the same content is stored already."""
+    sha256 = hashlib.sha256(content).hexdigest()
+    name = f'{MEDIA_PREFIX}{sha256[:16]}{extension}'
+    path = os.path.join(CACHE_FILES['media'], name)
+    if os.path.exists(path):
+        count('media_files_total', result='duplicate')
+    else:
+        # Written under a name of its own first, as the same content can come in for two URLs at once.
+        temporary = f'{path}.{hashlib.sha256(url.encode()).hexdigest()[:8]}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(content)
+        os.replace(temporary, path)
+        count('media_files_total', result='stored')
+        count('media_bytes_total', len(content))
+    return [name, sha256, len(content)]
+
+def load_manifest():
+    if not os.path.exists(OUTPUT_FILES['media_manifest']):
+        return {}
+    manifest = pd.read_csv(OUTPUT_FILES['media_manifest'])
+    return {url: [file, sha256, size] for url, file, sha256, size in manifest[['url', 'file', 'sha256', 'bytes']].itertuples(index=False)}
+
+def package_media(enabled=True):
+    """
+    Download the media of the deck into CACHE_FILES['media'] and write the manifest of the files.
+    Without enabled, nothing is downloaded and the manifest of an earlier build is kept, so packaging
+    can be turned on again without downloading the files that are still there. The transcode stage
+    then leaves the media files empty and the deck keeps linking to the media online.
+    """
+    print('-------- Packaging media --------')
+    if not enabled:
+        print('Media packaging is off, the deck links to the media online')
+        if not os.path.exists(OUTPUT_FILES['media_manifest']):
+            pd.DataFrame(columns=MANIFEST_COLUMNS).to_csv(OUTPUT_FILES['media_manifest'], index=False)
+        return
+
+    urls = media_urls()
+    os.makedirs(CACHE_FILES['media'], exist_ok=True)
+    stored = lambda entry: os.path.exists(os.path.join(CACHE_FILES['media'], entry[0]))
+
+    # Files from earlier builds, and from the journal of an interrupted run, are kept while they are still there.
+    journal = Journal('media')
+    known = {**load_manifest(), **journal.completed()}
+    files = {url: known[url] for url in urls if url in known and stored(known[url])}
+    pending = [url for url in urls if url not in files]
+    print(f'{len(urls)} media files in the deck, {len(files)} already packaged, {len(pending)} to download')
+    count('media_files_total', len(files), result='reused')
+
+    def download(url):
+        # Media is stored by content hash, so the response cache would only keep a second copy of it.
+        response = fetch_url(url, use_cache=False)
+        if response is None:
+            journal.record_failure(url)
+            count('media_files_total', result='failed')
+            return None
+        entry = store_media(url, response.content, media_extension(url, response))
+        journal.record(url, entry)
+        return entry
+
+    for url, entry in zip(pending, map_concurrent(download, pending, desc='Downloading media')):
+        if entry:
+            files[url] = entry
+    journal.flush()
+
+    manifest = pd.DataFrame([[url, kind] + files[url] for url, kind in urls.items() if url in files], columns=MANIFEST_COLUMNS)
+    print(f"{len(manifest)} of {len(urls)} media files packaged as {manifest['file'].nunique()} files, "
+          f"{manifest.drop_duplicates('file')['bytes'].sum() / 1e6:.1f} MB")
+    with timed_io('write', OUTPUT_FILES['media_manifest']):
+        manifest.to_csv(OUTPUT_FILES['media_manifest'], index=False)
+    finish_journal(journal)
+
+def localize_media(df, columns, manifest_file):
+    """
+    Point the src attributes in the HTML columns at the files in the manifest, keeping URLs that are not in it.
+    Types of <source> tags are updated for files that were transcoded to another format.
+    """
+    manifest = pd.read_csv(manifest_file, usecols=['url', 'file'])
+    if manifest.empty:
+        return
+    files = dict(zip(manifest['url'], manifest['file']))
+
+    def localize(match):
+        file = files.get(match[1])
+        if file is None:
+            return match[0]
+        media_type = match[2] and mimetypes.guess_type(file)[0]
+        return f'src="{file}"' + (f' type="{media_type}"' if media_type else match[2] or '')
+
+    for column in columns:
+        df[column] = df[column].str.replace(LOCALIZE_PATTERN, localize, regex=True)
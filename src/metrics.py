@@ -0,0 +1,201 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import bisect
+import math
+import time
+import json
+import sys
+import os
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+"""
+Timers, counters and histograms for the pipeline stages.
+
+Everything recorded while a stage runs is labelled with that stage, also from the threads of map_concurrent.
+The pipeline wraps every stage in stage_scope, which also keeps the stage's duration and the peak RSS of the
+process at its end, and can profile the stage with pyinstrument (when installed) or cProfile.
+The collected data is written as JSON or in the Prometheus text format with write_metrics.
+"""
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+
+_stage = ContextVar('stage', default=None)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)}}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        stage = _stage.get()
+        if stage and 'stage' not in labels:
+            labels = {'stage': stage, **labels}
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def count(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()} for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for kind, values in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines.extend(f'{name}{format_labels(labels)} {value}' for (other, labels), value in sorted(values.items()) if other == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else str(bound)
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+METRICS = Metrics()
+count = METRICS.count
+gauge = METRICS.gauge
+observe = METRICS.observe
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the seconds the block takes in the histogram name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe(name, time.perf_counter() - start, **labels)
+
+@contextmanager
+def timed_io(operation, path, **labels):
+    """Time reading or writing a file, and count its size once the block is done."""
+    with timer('io_seconds', operation=operation, file=os.path.basename(path), **labels):
+        yield
+    if os.path.exists(path):
+        METRICS.count('io_bytes_total', os.path.getsize(path), operation=operation, file=os.path.basename(path), **labels)
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, or None where the resource module is missing."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+@contextmanager
+def stage_scope(stage, profile_dir=None):
+    """
+    Label everything recorded in the block with the stage, and keep its duration and the process's peak RSS at its end.
+    Stages that run concurrently share the process, so the peak RSS is the highest of the process until then.
+    With profile_dir, the block is profiled into {profile_dir}/{stage}.html with pyinstrument, or {stage}.prof with cProfile.
+    Both only see the thread the stage runs in, not the worker threads of map_concurrent.
+    """
+    token = _stage.set(stage)
+    profiler = start_profiler() if profile_dir else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.gauge('stage_seconds', time.perf_counter() - start)
+        rss = peak_rss()
+        if rss is not None:
+            METRICS.gauge('stage_peak_rss_bytes', rss)
+        if profiler:
+            stop_profiler(profiler, profile_dir, stage)
+        _stage.reset(token)
+
+def start_profiler():
+    try:
+        from pyinstrument import Profiler
+        profiler = Profiler()
+    except ImportError:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    profiler.start()
+    return profiler
+
+def stop_profiler(profiler, profile_dir, stage):
+    os.makedirs(profile_dir, exist_ok=True)
+    if hasattr(profiler, 'output_html'):
+        profiler.stop()
+        with open(os.path.join(profile_dir, f'{stage}.html'), 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(profile_dir, f'{stage}.prof'))
+
+def write_metrics(path):
+    """Write everything recorded so far, as JSON when the path ends in .json and in the Prometheus text format otherwise."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            json.dump(METRICS.to_json(), f, indent=2)
+        else:
+            f.write(METRICS.to_prometheus())
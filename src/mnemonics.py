@@ -1,17 +1,39 @@
+import pandas as pd
 from file_paths import INPUT_FILES, PROCESSED_FILES
+from names import normalize_names
+from store import save_to_store
+from metrics import count, timed_io
+
+def read_mnemonics(path):
+    """
+    Parse the mnemonics file into a dict from bird name to its <br/>-joined mnemonics.
+    Birds are separated by an empty line, the first line of each is the name. A later entry for the same name replaces the earlier one.
+    """
+    with open(path) as f:
+        birds = f.read().split('\n\n')
+
+    mnemonics = {}
+    for bird in birds:
+        lines = bird.split('\n')
+        mnemonics[lines[0]] = '<br/>'.join(lines[1:])
+    return mnemonics
 
 def process_mnemonics(df):
     """
     Matching mnemonics by PRIMARY_COM_NAME from a txt file (copied from Warbler Watch)
+    Names that don't match exactly fall back to the normalized name, for mnemonics keyed on older spellings.
     """
     print('-------- Getting mnemonics --------')
     df = df[['English (Clements)', 'Scientific (Clements)']].copy()
 
-    with open(INPUT_FILES['mnemonics']) as f:
-        birds = f.read().split('\n\n')
+    mnemonics = pd.Series(read_mnemonics(INPUT_FILES['mnemonics']), dtype=object)
+    by_key = mnemonics.set_axis(normalize_names(mnemonics.index.to_series()))
+    by_key = by_key[~by_key.index.duplicated(keep='last')]
 
-    for bird in birds:
-        mnemonics = bird.split('\n')
-        df.loc[df['English (Clements)'] == mnemonics[0], 'MNEMONIC'] = '<br/>'.join(mnemonics[1:])
+    df['MNEMONIC'] = df['English (Clements)'].map(mnemonics)
+    df['MNEMONIC'] = df['MNEMONIC'].fillna(normalize_names(df['English (Clements)']).map(by_key))
 
-    df[['Scientific (Clements)', 'MNEMONIC']].to_csv(PROCESSED_FILES['mnemonics'], index=False)
\ No newline at end of file
+    count('rows_processed_total', len(df))
+    with timed_io('write', PROCESSED_FILES['mnemonics']):
+        df[['Scientific (Clements)', 'MNEMONIC']].to_csv(PROCESSED_FILES['mnemonics'], index=False)
+    save_to_store('mnemonics')
@@ -0,0 +1,84 @@
+import pandas as pd
+import threading
+import re
+
+"""
+Normalized bird names, used to match names that only differ in spelling between checklists.
+
+Each distinct name is normalized once per process and the keys are shared by every stage.
+"""
+GRAY = re.compile(r'gray')
+POSSESSIVE = re.compile(r"s's\b")
+HYPHENS_AND_WHITESPACE = re.compile(r'[-\s]+')
+
+_normalized = {}
+_normalized_lock = threading.Lock()
+
+def normalize_name(name):
+    """Compact key for a name: lower case, grey instead of gray, s' instead of s's and no hyphens or whitespace."""
+    if not isinstance(name, str):
+        return None
+    key = name.lower()
+    key = GRAY.sub('grey', key)
+    key = POSSESSIVE.sub("s'", key)
+    return HYPHENS_AND_WHITESPACE.sub('', key)
+
+def normalize_names(names):
+    """Normalized keys for a Series of names, only normalizing names that weren't seen before."""
+    with _normalized_lock:
+        for name in names.dropna().unique():
+            if name not in _normalized:
+                _normalized[name] = normalize_name(name)
+        return names.map(_normalized)
+
+
+class NameIndex:
+    """
+    Lookup of rows in a reference table by name, either on the exact name or on its normalized key.
+    When several rows share a name, the first one wins.
+    """
+    def __init__(self, df, column):
+        self.df = df.reset_index(drop=True)
+        names = self.df[column]
+        self.exact = pd.Series(names.index, index=names).loc[lambda rows: ~rows.index.duplicated() & rows.index.notna()]
+        keys = normalize_names(names)
+        self.normalized = pd.Series(keys.index, index=keys).loc[lambda rows: ~rows.index.duplicated() & rows.index.notna()]
+
+    def lookup(self, names, normalized=False):
+        """Row of the reference table for each name (NaN where there is none)."""
+        if normalized:
+            return normalize_names(names).map(self.normalized)
+        return names.map(self.exact)
+
+
+def resolve_ioc(df, ioc, crosswalk):
+    """
+    Find the IOC names for each Clements species, trying in order:
+      1. 'scientific': the Clements scientific name in the IOC list
+      2. 'common': the normalized Clements common name in the IOC list
+      3. 'crosswalk scientific': the Clements scientific name in the Clements-IOC crosswalk
+      4. 'crosswalk common': the normalized Clements common name in the crosswalk
+    Both tables need 'English (IOC)' and 'Scientific (IOC)' columns, the crosswalk also the Clements names.
+    Adds 'English (IOC)', 'Scientific (IOC)' and 'IOC match' with the step that matched.
+    """
+    df = df.copy()
+    for column in ['English (IOC)', 'Scientific (IOC)', 'IOC match']:
+        df[column] = pd.Series(pd.NA, index=df.index, dtype=object)
+
+    steps = [
+        ('scientific', NameIndex(ioc, 'Scientific (IOC)'), 'Scientific (Clements)', False),
+        ('common', NameIndex(ioc, 'English (IOC)'), 'English (Clements)', True),
+        ('crosswalk scientific', NameIndex(crosswalk, 'Scientific (Clements)'), 'Scientific (Clements)', False),
+        ('crosswalk common', NameIndex(crosswalk, 'English (Clements)'), 'English (Clements)', True),
+    ]
+    for match, index, column, normalized in steps:
+        missing = df['English (IOC)'].isna()
+        rows = index.lookup(df.loc[missing, column], normalized=normalized).dropna().astype(int)
+        matches = index.df.loc[rows.values, ['English (IOC)', 'Scientific (IOC)']].set_axis(rows.index)
+        # Only accept rows that actually have an IOC name.
+        matches = matches[matches['English (IOC)'].notna()]
+        df.loc[matches.index, 'English (IOC)'] = matches['English (IOC)']
+        df.loc[matches.index, 'Scientific (IOC)'] = matches['Scientific (IOC)']
+        df.loc[matches.index, 'IOC match'] = match
+
+    return df
@@ -0,0 +1,287 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from file_paths import INPUT_FILES, PROCESSED_FILES, OUTPUT_FILES, CACHE_FILES
+from utils import file_hash
+from metrics import stage_scope
+import threading
+import hashlib
+import ast
+import json
+import os
+
+"""
+Small build engine for the stages in main.py.
+
+Each stage declares the files it reads and writes and the source files its code lives in,
+to which the modules in src they import are added. A stage is up to date when its outputs exist
+and the fingerprint of its inputs, code and options matches the one recorded after its last
+successful run. Stages whose inputs are produced by other stages wait for them, everything else
+runs concurrently.
+"""
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def local_imports(code):
+    """The given source files and the ones in SRC_DIR they import, directly or through other modules."""
+    found = set()
+    pending = list(code)
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(os.path.join(SRC_DIR, path)) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules = [node.module]
+            else:
+                continue
+            pending.extend(f'{module}.py' for module in modules if os.path.exists(os.path.join(SRC_DIR, f'{module}.py')))
+    return sorted(found)
+
+class Stage:
+    def __init__(self, name, run, inputs, outputs, code, options=()):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.code = local_imports(code)
+        self.options = options  # Names of the run options that change the outputs
+
+def run_base_data(options):
+    from base_data import get_base_data
+    get_base_data()
+
+def run_taxonomy_diff(options):
+    from taxonomy_diff import diff_taxonomy
+    diff_taxonomy()
+
+def run_translations(options):
+    from base_data import load_base_data
+    from translations import merge_translations
+    merge_translations(load_base_data())
+
+def run_mnemonics(options):
+    from base_data import load_base_data
+    from mnemonics import process_mnemonics
+    process_mnemonics(load_base_data())
+
+def run_avibase(options):
+    from base_data import load_base_data
+    from avibase import scrape_avibase_data
+    scrape_avibase_data(load_base_data())
+
+def run_images(options):
+    from base_data import load_base_data
+    from images import scrape_images
+    scrape_images(load_base_data(), incremental=options.get('incremental', False))
+
+def run_audio(options):
+    from base_data import load_base_data
+    from audio import get_audio
+    get_audio(load_base_data(), streaming=options.get('streaming', False), incremental=options.get('incremental', False))
+
+def run_media(options):
+    from media import package_media
+    package_media(enabled=options.get('package_media', False))
+
+def run_transcode(options):
+    from transcode import transcode_media, IMAGE_WIDTH, IMAGE_QUALITY, AUDIO_BITRATE
+    transcode_media(enabled=options.get('package_media', False),
+                    image_format=options.get('transcode_images'),
+                    image_width=options.get('image_width') or IMAGE_WIDTH,
+                    image_quality=options.get('image_quality') or IMAGE_QUALITY,
+                    audio_format=options.get('transcode_audio'),
+                    audio_bitrate=options.get('audio_bitrate') or AUDIO_BITRATE)
+
+def run_combine(options):
+    from base_data import load_base_data
+    from combine_data import combine_data
+    combine_data(load_base_data(), options['version_tag'], gzip_sidecar=options.get('gzip', False))
+
+STAGES = {stage.name: stage for stage in [
+    Stage('base', run_base_data,
+          inputs=[INPUT_FILES['ebird_taxonomy'], INPUT_FILES['ioc_translations'], INPUT_FILES['clements_to_ioc']],
+          outputs=[OUTPUT_FILES['base_data']],
+          code=['base_data.py']),
+    Stage('diff', run_taxonomy_diff,
+          inputs=[OUTPUT_FILES['base_data'], INPUT_FILES['previous_base_data'], INPUT_FILES['ebird_taxonomy'], INPUT_FILES['previous_taxonomy']],
+          outputs=[OUTPUT_FILES['taxonomy_diff']],
+          code=['taxonomy_diff.py']),
+    Stage('translations', run_translations,
+          inputs=[OUTPUT_FILES['base_data'], INPUT_FILES['ioc_translations'], INPUT_FILES['old_version']],
+          outputs=[PROCESSED_FILES['translations']],
+          code=['translations.py']),
+    Stage('mnemonics', run_mnemonics,
+          inputs=[OUTPUT_FILES['base_data'], INPUT_FILES['mnemonics']],
+          outputs=[PROCESSED_FILES['mnemonics']],
+          code=['mnemonics.py']),
+    Stage('avibase', run_avibase,
+          inputs=[OUTPUT_FILES['base_data']],
+          outputs=[PROCESSED_FILES['avibase']],
+          code=['avibase.py']),
+    Stage('images', run_images,
+          inputs=[OUTPUT_FILES['base_data'], OUTPUT_FILES['taxonomy_diff']],
+          outputs=[PROCESSED_FILES['images']],
+          code=['images.py', 'taxonomy_diff.py'],
+          options=['incremental']),
+    Stage('audio', run_audio,
+          inputs=[OUTPUT_FILES['base_data'], OUTPUT_FILES['taxonomy_diff'], INPUT_FILES['audio_files'], INPUT_FILES['audio_data']],
+          outputs=[PROCESSED_FILES['audio']],
+          code=['audio.py', 'taxonomy_diff.py'],
+          options=['incremental']),
+    Stage('media', run_media,
+          inputs=[PROCESSED_FILES['images'], PROCESSED_FILES['audio']],
+          outputs=[OUTPUT_FILES['media_manifest']],
+          code=['media.py'],
+          options=['package_media']),
+    Stage('transcode', run_transcode,
+          inputs=[OUTPUT_FILES['media_manifest']],
+          outputs=[OUTPUT_FILES['media_files']],
+          code=['transcode.py', 'media.py'],
+          options=['package_media', 'transcode_images', 'image_width', 'image_quality', 'transcode_audio', 'audio_bitrate']),
+    Stage('combine', run_combine,
+          inputs=[OUTPUT_FILES['base_data'], INPUT_FILES['notes'], OUTPUT_FILES['media_files']] + list(PROCESSED_FILES.values()),
+          outputs=[OUTPUT_FILES['output'], OUTPUT_FILES['output_header'], OUTPUT_FILES['output_notes']],
+          code=['combine_data.py', 'translations.py', 'media.py'],
+          options=['version_tag', 'gzip']),
+]}
+
+def dependencies(stage):
+    """Stages that produce one of the stage's inputs."""
+    return [other.name for other in STAGES.values() if other is not stage and set(other.outputs) & set(stage.inputs)]
+
+def has_outputs(stage):
+    return all(os.path.exists(path) for path in stage.outputs)
+
+def upstream(names, missing_only=False):
+    """
+    The given stages and everything they depend on.
+    With missing_only, only the stages upstream whose outputs are missing, as the given ones can't run without them.
+    """
+    needed = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(dep for dep in dependencies(STAGES[name]) if not missing_only or not has_outputs(STAGES[dep]))
+    return needed
+
+
+class Pipeline:
+    def __init__(self, options, state_file=None):
+        self.options = options
+        self.state_file = state_file or CACHE_FILES['pipeline']
+        self.lock = threading.Lock()
+        self.state = {'fingerprints': {}, 'hashes': {}}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def hash_file(self, path):
+        # Hashing the audio archive takes a while, so hashes are reused while size and mtime are unchanged.
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            cached = self.state['hashes'].get(path)
+        if cached and cached['stamp'] == stamp:
+            return cached['sha256']
+        digest = file_hash(path)
+        with self.lock:
+            self.state['hashes'][path] = {'stamp': stamp, 'sha256': digest}
+        return digest
+
+    def fingerprint(self, stage):
+        sha = hashlib.sha256(stage.name.encode())
+        for path in stage.inputs:
+            sha.update(f'{path}:{self.hash_file(path)}\n'.encode())
+        for path in stage.code:
+            sha.update(f'{path}:{self.hash_file(os.path.join(SRC_DIR, path))}\n'.encode())
+        for option in stage.options:
+            sha.update(f'{option}={self.options.get(option)}\n'.encode())
+        return sha.hexdigest()
+
+    def is_up_to_date(self, stage, seed=True):
+        """
+        Whether the stage's outputs exist and its fingerprint matches the last run.
+        Outputs without a recorded fingerprint, from before the pipeline state existed or after it was deleted,
+        are taken as up to date and their fingerprint is recorded (seed), unless a stage they depend on just ran.
+        """
+        if not has_outputs(stage):
+            return False
+        fingerprint = self.fingerprint(stage)
+        with self.lock:
+            recorded = self.state['fingerprints'].get(stage.name)
+            if recorded is None and seed:
+                print(f'Recording the existing outputs of {stage.name}')
+                self.state['fingerprints'][stage.name] = fingerprint
+                self.save_state()
+                return True
+            return recorded == fingerprint
+
+    def run_stage(self, stage):
+        # Metrics recorded by the stage are labelled with its name, and with the profile option it is profiled as well.
+        with stage_scope(stage.name, self.options.get('profile')):
+            stage.run(self.options)
+
+    def run(self, targets=None, force=(), jobs=None, dry_run=False, no_deps=False):
+        """
+        Bring the targets (all stages by default) up to date.
+        Stages in force are rebuilt even if they are up to date.
+        With no_deps, the stages the targets depend on are only run when their outputs are missing.
+        """
+        names = upstream(targets or STAGES, missing_only=no_deps)
+        done, failed, planned, ran, running = set(), set(), set(), set(), {}
+
+        with ThreadPoolExecutor(max_workers=jobs or len(names)) as executor:
+            while len(done) + len(failed) < len(names):
+                for name in sorted(names - done - failed - set(running)):
+                    deps = set(dependencies(STAGES[name])) & names
+                    if deps & failed:
+                        print(f'Skipping {name}: {", ".join(sorted(deps & failed))} failed')
+                        failed.add(name)
+                    elif deps <= done:
+                        stage = STAGES[name]
+                        if name not in force and not deps & planned and self.is_up_to_date(stage, seed=not deps & ran):
+                            print(f'{name} is up to date')
+                            done.add(name)
+                        elif dry_run:
+                            # Nothing is built, so stages downstream of this one would run as well.
+                            print(f'Would run {name}')
+                            planned.add(name)
+                            done.add(name)
+                        else:
+                            print(f'Running {name}')
+                            running[name] = executor.submit(self.run_stage, stage)
+                if not running:
+                    continue
+
+                finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name, future in list(running.items()):
+                    if future not in finished:
+                        continue
+                    del running[name]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'Stage {name} failed: {e}')
+                        failed.add(name)
+                        continue
+                    fingerprint = self.fingerprint(STAGES[name])
+                    with self.lock:
+                        self.state['fingerprints'][name] = fingerprint
+                        self.save_state()
+                    ran.add(name)
+                    done.add(name)
+
+        return not failed
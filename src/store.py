@@ -0,0 +1,158 @@
+from file_paths import PROCESSED_FILES, CACHE_FILES
+from base_data import BASE_COLUMNS
+from utils import file_hash
+from metrics import count, timed_io
+import pandas as pd
+import threading
+import sqlite3
+import os
+
+"""
+Indexed SQLite store of the processed data, keyed by Scientific (Clements).
+
+Every stage has a table: avibase, mnemonics, images and audio with a row per species, translations with a row per
+species and language, and base with the species of the deck in their order. Stages load their processed file into
+their table when they are done, and the image scraper upserts every species as soon as it is scraped, so single
+species can be looked up while a stage runs and updated without rewriting a file.
+
+The species_wide view joins the tables into the rows of the deck, with the translations pivoted to a column per
+language, and is what combine_data reads instead of merging the processed files in pandas.
+The processed files stay the output of the stages: sync loads every file that changed since its table was loaded,
+so the store can be deleted and is rebuilt on the next combine.
+"""
+KEY = 'Scientific (Clements)'
+STAGE_COLUMNS = {
+    'avibase': ['TAGS', 'AVIBASE', 'CONS_STATUS'],
+    'translations': ['language', 'name'],
+    'mnemonics': ['MNEMONIC'],
+    'images': ['IMAGES', 'DESC'],
+    'audio': ['SOUNDS'],
+}
+# Translations have a row per language of each species, the other stages a row per species.
+STAGE_KEYS = {stage: [KEY, 'language'] if stage == 'translations' else [KEY] for stage in STAGE_COLUMNS}
+BUSY_TIMEOUT = 60
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def species_wide_sql():
+    """The view with the base columns, then the columns of every stage in the order of PROCESSED_FILES."""
+    from translations import LANGUAGES
+
+    columns = ['base.position'] + [f'base.{quote(column)}' for column in BASE_COLUMNS]
+    joins = []
+    for stage in PROCESSED_FILES:
+        if stage == 'translations':
+            # A lookup on the primary key per language, so a single species doesn't pivot the whole table.
+            columns += [f'(SELECT name FROM translations WHERE {quote(KEY)} = base.{quote(KEY)} AND language = \'{language}\') AS {quote(language)}'
+                        for language in LANGUAGES]
+        else:
+            columns += [f'{stage}.{quote(column)}' for column in STAGE_COLUMNS[stage]]
+            joins.append(f'LEFT JOIN {stage} ON {stage}.{quote(KEY)} = base.{quote(KEY)}')
+    return f'CREATE VIEW species_wide AS SELECT {", ".join(columns)} FROM base {" ".join(joins)} ORDER BY base.position'
+
+
+class SpeciesStore:
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        path = path or CACHE_FILES['store']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several stages write at the same time, each waits for the others' transactions.
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # Everything in the store can be loaded again from the processed files, so commits don't wait for the disk.
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.create_tables()
+
+    def create_tables(self):
+        base_columns = ', '.join(f'{quote(column)} {"INTEGER" if column == "TAXON_ORDER" else "TEXT"}' for column in BASE_COLUMNS)
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS base (position INTEGER PRIMARY KEY, {base_columns})')
+        self.db.execute(f'CREATE INDEX IF NOT EXISTS base_species ON base ({quote(KEY)})')
+        for stage, columns in STAGE_COLUMNS.items():
+            key = ', '.join(quote(column) for column in STAGE_KEYS[stage])
+            values = ', '.join(f'{quote(column)} TEXT' for column in columns)
+            self.db.execute(f'CREATE TABLE IF NOT EXISTS {stage} ({quote(KEY)} TEXT NOT NULL, {values}, PRIMARY KEY ({key})) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources (stage TEXT PRIMARY KEY, sha256 TEXT NOT NULL)')
+
+        # The view is recreated when its definition changed, e.g. after a language was added.
+        view = species_wide_sql()
+        current = self.db.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'species_wide'").fetchone()
+        if current is None or current[0] != view:
+            self.db.execute('DROP VIEW IF EXISTS species_wide')
+            self.db.execute(view)
+
+    def _upsert(self, stage, rows):
+        columns = [KEY] + STAGE_COLUMNS[stage]
+        # Empty strings are stored as NULL, like they are read from the processed files.
+        values = rows[columns].astype(object)
+        values = values.where(values.notna() & (values != ''), None)
+        updates = ', '.join(f'{quote(column)} = excluded.{quote(column)}' for column in columns if column not in STAGE_KEYS[stage])
+        self.db.executemany(
+            f'INSERT INTO {stage} ({", ".join(quote(column) for column in columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT ({", ".join(quote(column) for column in STAGE_KEYS[stage])}) DO UPDATE SET {updates}',
+            values.itertuples(index=False, name=None)
+        )
+
+    def upsert(self, stage, rows):
+        """Insert or update the rows (with Scientific (Clements) and the stage's columns) in the stage's table."""
+        with self.lock, self.db:
+            self._upsert(stage, rows)
+        count('store_rows_upserted_total', len(rows), table=stage)
+
+    def load(self, stage):
+        """Replace the stage's table with its processed file, and remember which version of the file it holds."""
+        path = PROCESSED_FILES[stage]
+        with timed_io('read', path):
+            if stage == 'translations':
+                rows = pd.read_csv(path, dtype='str', na_values=[''], keep_default_na=False)
+            else:
+                rows = pd.read_csv(path, dtype='str', na_values=[''])
+        with self.lock, self.db:
+            self.db.execute(f'DELETE FROM {stage}')
+            self._upsert(stage, rows)
+            self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)', (stage, file_hash(path)))
+        count('store_rows_upserted_total', len(rows), table=stage)
+
+    def sync(self):
+        """Load the processed files that changed since they were loaded into the store."""
+        with self.lock:
+            loaded = dict(self.db.execute('SELECT stage, sha256 FROM sources').fetchall())
+        for stage, path in PROCESSED_FILES.items():
+            if loaded.get(stage) != file_hash(path):
+                print(f'Loading {path} into the species store')
+                self.load(stage)
+
+    def load_base(self, df):
+        """Replace the species of the deck, keeping the index of df as their position."""
+        values = df[BASE_COLUMNS].astype(object).where(df[BASE_COLUMNS].notna(), None)
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM base')
+            self.db.executemany(
+                f'INSERT INTO base (position, {", ".join(quote(column) for column in BASE_COLUMNS)}) VALUES ({", ".join("?" * (len(BASE_COLUMNS) + 1))})',
+                values.itertuples(index=True, name=None)
+            )
+
+    def read_wide(self):
+        """Every row of the species_wide view, indexed by the species' position in the base data."""
+        with self.lock:
+            return pd.read_sql_query('SELECT * FROM species_wide', self.db, index_col='position').rename_axis(None)
+
+    def species(self, scientific_name):
+        """Point lookup of a species in the species_wide view, as a dict of its columns (None if it isn't there)."""
+        with self.lock:
+            cursor = self.db.execute(f'SELECT * FROM species_wide WHERE {quote(KEY)} = ?', (scientific_name,))
+            row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def close(self):
+        self.db.close()
+
+
+def save_to_store(stage):
+    """Load the processed file a stage just wrote into its table of the store."""
+    store = SpeciesStore()
+    try:
+        store.load(stage)
+    finally:
+        store.close()
@@ -0,0 +1,129 @@
+import pandas as pd
+import os
+from file_paths import INPUT_FILES, OUTPUT_FILES
+from metrics import count, timed_io
+
+"""
+Differences between the taxonomy of this version of the deck and the previous one.
+
+Every species in base_data.csv is compared with the base data of the previous version on its eBird species
+code, and on its scientific and then English name for species whose code changed:
+  unchanged  same code and the same Clements and IOC names
+  renamed    in the previous version, but under another name or code
+  split      split off from a previous species, or a previous species that had a part split off
+  lumped     a species that previous species were merged into
+  new        not in the previous version
+Splits and lumps come from REPORT_AS in the eBird taxonomies: a subspecies group of the previous taxonomy
+that is a species now was split off, and a previous species that is now a group was lumped into the species
+it is reported as. Without the previous taxonomy they show up as new or renamed.
+
+With the incremental option, the images and audio stages only process the species that are not unchanged
+and reuse the rows of their previous output for the rest. Avibase is always scraped in full, as the tags of
+every species are collected from all country pages anyway.
+"""
+CHANGES = ['unchanged', 'renamed', 'split', 'lumped', 'new']
+NAME_COLUMNS = ['English (Clements)', 'Scientific (Clements)', 'English (IOC)', 'Scientific (IOC)']
+
+def read_reported_as(path):
+    """The taxa of an eBird taxonomy that are not a species but reported as one, with the code of that species."""
+    if not os.path.exists(path):
+        return None
+    taxonomy = pd.read_csv(path, dtype='str')
+    if 'REPORT_AS' not in taxonomy:
+        return None
+    groups = taxonomy[(taxonomy['CATEGORY'] != 'species') & taxonomy['REPORT_AS'].notna()]
+    return groups.drop_duplicates('SPECIES_CODE').set_index('SPECIES_CODE')['REPORT_AS']
+
+def classify_species(current, previous, previous_reported_as=None, current_reported_as=None):
+    """
+    Classify each species of the current base data by how it changed since the previous one.
+
+    Args:
+        current, previous (DataFrame): Base data with SPECIES_CODE and NAME_COLUMNS.
+        previous_reported_as, current_reported_as (Series): See read_reported_as.
+
+    Returns:
+        DataFrame: The code and Clements names of every current species, its CHANGE,
+                   and the code and scientific name it had in the previous version.
+    """
+    codes = current['SPECIES_CODE']
+    previous = previous.drop_duplicates('SPECIES_CODE')
+
+    # Species whose code changed are found by their name, among the previous species that are not matched on their code.
+    previous_code = codes.where(codes.isin(previous['SPECIES_CODE']))
+    unmatched = previous[~previous['SPECIES_CODE'].isin(codes)]
+    for column in ['Scientific (Clements)', 'English (Clements)']:
+        by_name = unmatched.drop_duplicates(column).set_index(column)['SPECIES_CODE']
+        previous_code = previous_code.fillna(current[column].map(by_name))
+
+    previous = previous.set_index('SPECIES_CODE')
+    same = previous_code == codes
+    for column in NAME_COLUMNS:
+        same &= current[column].fillna('') == previous_code.map(previous[column]).fillna('')
+
+    change = pd.Series('new', index=current.index)
+    change[previous_code.notna()] = 'renamed'
+    change[same] = 'unchanged'
+
+    if previous_reported_as is not None:
+        split_from = codes.map(previous_reported_as).where(~codes.isin(previous.index))
+        change[split_from.notna() | codes.isin(split_from.dropna())] = 'split'
+    if current_reported_as is not None:
+        lumped_into = current_reported_as[current_reported_as.index.isin(previous.index)]
+        change[codes.isin(lumped_into)] = 'lumped'
+
+    df = current[['SPECIES_CODE', 'English (Clements)', 'Scientific (Clements)']].copy()
+    df['CHANGE'] = change
+    df['PREVIOUS_CODE'] = previous_code
+    df['Scientific (previous)'] = previous_code.map(previous['Scientific (Clements)'])
+
+    gone = ~previous.index.isin(previous_code.dropna())
+    if current_reported_as is not None:
+        gone &= ~previous.index.isin(current_reported_as.index)
+    print(f'{gone.sum()} species of the previous version are not in the taxonomy anymore')
+    return df
+
+def diff_taxonomy():
+    """Write the change of every species since the previous version to OUTPUT_FILES['taxonomy_diff']."""
+    print('-------- Comparing taxonomies --------')
+    columns = ['SPECIES_CODE'] + NAME_COLUMNS
+    with timed_io('read', OUTPUT_FILES['base_data']):
+        current = pd.read_csv(OUTPUT_FILES['base_data'], usecols=columns, dtype='str')
+
+    if os.path.exists(INPUT_FILES['previous_base_data']):
+        previous = pd.read_csv(INPUT_FILES['previous_base_data'], usecols=columns, dtype='str')
+    else:
+        print(f"{INPUT_FILES['previous_base_data']} not found, every species is new")
+        previous = pd.DataFrame(columns=columns, dtype='str')
+
+    df = classify_species(current, previous, read_reported_as(INPUT_FILES['previous_taxonomy']), read_reported_as(INPUT_FILES['ebird_taxonomy']))
+    print(df['CHANGE'].value_counts().reindex(CHANGES, fill_value=0).to_string())
+
+    count('rows_processed_total', len(df))
+    with timed_io('write', OUTPUT_FILES['taxonomy_diff']):
+        df.to_csv(OUTPUT_FILES['taxonomy_diff'], index=False)
+
+def split_unchanged(df, processed_file):
+    """
+    Split the species of df into the ones that have to be processed again, and the rows of the previous
+    processed file that are reused for the unchanged ones. Unchanged species without a previous row are processed as well.
+    """
+    if not os.path.exists(processed_file):
+        print(f'{processed_file} not found, processing every species')
+        return df, None
+
+    changes = pd.read_csv(OUTPUT_FILES['taxonomy_diff'], usecols=['Scientific (Clements)', 'CHANGE'])
+    unchanged = changes.loc[changes['CHANGE'] == 'unchanged', 'Scientific (Clements)']
+    previous = pd.read_csv(processed_file).drop_duplicates('Scientific (Clements)')
+    reuse = df['Scientific (Clements)'].isin(unchanged) & df['Scientific (Clements)'].isin(previous['Scientific (Clements)'])
+
+    print(f'Reusing {reuse.sum()} unchanged species from {processed_file}, {(~reuse).sum()} to process')
+    count('species_reused_total', int(reuse.sum()))
+    return df[~reuse].copy(), previous[previous['Scientific (Clements)'].isin(df.loc[reuse, 'Scientific (Clements)'])]
+
+def with_reused(df, reused, species):
+    """Add the reused rows to the processed ones, in the order of the species."""
+    if reused is None:
+        return df
+    df = pd.concat([df, reused[df.columns]]).set_index('Scientific (Clements)')
+    return df.reindex(species).reset_index()
@@ -0,0 +1,169 @@
+import pandas as pd
+import subprocess
+import hashlib
+import shutil
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from tqdm import tqdm
+from file_paths import OUTPUT_FILES, CACHE_FILES
+from media import MEDIA_PREFIX
+from metrics import count, timed_io
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+"""
+Build the deck's media folder from the packaged media, transcoded to smaller files where enabled.
+
+The eBird images and the spectrograms are converted to WebP or AVIF with Pillow, at most IMAGE_WIDTH pixels wide,
+and recordings are re-encoded to Opus or a lower-bitrate MP3 with ffmpeg. Files are transcoded in a pool with a
+process per core into CACHE_FILES['transcode'], named after the hash of the source and of the settings, so the
+same file is never transcoded twice with the same settings. Where the result is not smaller, the source is kept.
+
+OUTPUT_FILES['media'] then holds exactly the files the deck links to, and OUTPUT_FILES['media_files'] maps every
+URL to its file in there, for combine_data. Copy the folder's files into Anki's collection.media folder before
+importing the deck.
+"""
+IMAGE_WIDTH = 640
+IMAGE_QUALITY = 75
+AUDIO_BITRATE = '64k'
+IMAGE_FORMATS = {'webp': ('WEBP', '.webp'), 'avif': ('AVIF', '.avif')}
+AUDIO_FORMATS = {'opus': ('libopus', '.ogg'), 'mp3': ('libmp3lame', '.mp3')}
+FILES_COLUMNS = ['url', 'file', 'kind', 'source_bytes', 'bytes']
+TRANSCODE_WORKERS = os.cpu_count() or 1
+
+def transcode_settings(image_format, image_width, image_quality, audio_format, audio_bitrate):
+    """The settings each kind of media is transcoded with, for the kinds that can be transcoded here."""
+    settings = {}
+    if image_format:
+        if Image is None:
+            print('Pillow is not installed, images are not transcoded')
+        elif not features.check(image_format):
+            print(f'Pillow was built without {image_format}, images are not transcoded')
+        else:
+            # Spectrograms are recompressed with the same settings as the images.
+            settings['image'] = settings['spectrogram'] = {'format': image_format, 'width': image_width, 'quality': image_quality}
+    if audio_format:
+        if shutil.which('ffmpeg') is None:
+            print('ffmpeg is not installed, recordings are not transcoded')
+        else:
+            settings['audio'] = {'format': audio_format, 'bitrate': audio_bitrate}
+    return settings
+
+def transcoded_name(sha256, settings):
+    key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:8]
+    extension = (IMAGE_FORMATS | AUDIO_FORMATS)[settings['format']][1]
+    return f'{MEDIA_PREFIX}{sha256[:16]}-{key}{extension}'
+
+def transcode_file(source, destination, kind, settings):
+    """Transcode a file in a worker process, returning the size of the result."""
+    root, extension = os.path.splitext(destination)
+    temporary = f'{root}.tmp{extension}'
+    if kind == 'audio':
+        codec, _ = AUDIO_FORMATS[settings['format']]
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', source, '-vn', '-c:a', codec, '-b:a', settings['bitrate'], temporary],
+                       check=True, capture_output=True)
+    else:
+        image_format, _ = IMAGE_FORMATS[settings['format']]
+        with Image.open(source) as image:
+            if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+            if image.width > settings['width']:
+                image.thumbnail((settings['width'], image.height))
+            image.save(temporary, image_format, quality=settings['quality'])
+    os.replace(temporary, destination)
+    return os.path.getsize(destination)
+
+def transcode_files(jobs):
+    """Run the (source, destination, kind, settings) jobs on every core, returning the destinations that failed."""
+    failed = set()
+    with ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS, mp_context=get_context('spawn')) as executor:
+        futures = {executor.submit(transcode_file, *job): job for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Transcoding media'):
+            source, destination, kind, _ = futures[future]
+            try:
+                future.result()
+                count('transcoded_files_total', kind=kind)
+            except Exception as e:
+                print(f'Error transcoding {source}: {e}')
+                count('transcode_failures_total', kind=kind)
+                failed.add(destination)
+    return failed
+
+def fill_media_folder(files):
+    """Make OUTPUT_FILES['media'] hold exactly the given files ({name: path}), linked from the caches where possible."""
+    folder = OUTPUT_FILES['media']
+    os.makedirs(folder, exist_ok=True)
+    for name in os.listdir(folder):
+        if name.startswith(MEDIA_PREFIX) and name not in files:
+            os.remove(os.path.join(folder, name))
+    for name, path in files.items():
+        # Names are derived from the content, so a file that is there already is the same file.
+        target = os.path.join(folder, name)
+        if os.path.exists(target):
+            continue
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+
+def transcode_media(enabled=True, image_format=None, image_width=IMAGE_WIDTH, image_quality=IMAGE_QUALITY, audio_format=None, audio_bitrate=AUDIO_BITRATE):
+    """
+    Fill OUTPUT_FILES['media'] with the packaged media, transcoded with the given formats, and write OUTPUT_FILES['media_files'].
+    Without a format for a kind of media, its files are used as they were downloaded.
+    Without enabled (media packaging is off), OUTPUT_FILES['media_files'] is left empty, whatever the manifest holds.
+    """
+    print('-------- Transcoding media --------')
+    if not enabled:
+        print('Media packaging is off, the deck links to the media online')
+        pd.DataFrame(columns=FILES_COLUMNS).to_csv(OUTPUT_FILES['media_files'], index=False)
+        return
+    with timed_io('read', OUTPUT_FILES['media_manifest']):
+        manifest = pd.read_csv(OUTPUT_FILES['media_manifest'])
+    if manifest.empty:
+        print('No packaged media, the deck links to the media online')
+        pd.DataFrame(columns=FILES_COLUMNS).to_csv(OUTPUT_FILES['media_files'], index=False)
+        return
+
+    settings = transcode_settings(image_format, image_width, image_quality, audio_format, audio_bitrate)
+    manifest['source'] = CACHE_FILES['media'] + os.sep + manifest['file']
+
+    # Files are transcoded once per source and settings, later builds reuse them from the cache.
+    os.makedirs(CACHE_FILES['transcode'], exist_ok=True)
+    sources = manifest.drop_duplicates('file')
+    outputs = {}
+    for file, sha256, kind, source in zip(sources['file'], sources['sha256'], sources['kind'], sources['source']):
+        if kind in settings:
+            outputs[file] = os.path.join(CACHE_FILES['transcode'], transcoded_name(sha256, settings[kind]))
+    jobs = [(source, outputs[file], kind, settings[kind])
+            for file, kind, source in zip(sources['file'], sources['kind'], sources['source'])
+            if file in outputs and not os.path.exists(outputs[file])]
+    print(f'{len(outputs)} of {len(sources)} files to transcode, {len(outputs) - len(jobs)} of them already transcoded')
+    failed = transcode_files(jobs) if jobs else set()
+
+    # The source is kept where transcoding failed or didn't make the file smaller.
+    paths = {}
+    for file, source, source_bytes in zip(sources['file'], sources['source'], sources['bytes']):
+        output = outputs.get(file)
+        if output and output not in failed and os.path.getsize(output) < source_bytes:
+            paths[file] = output
+        else:
+            paths[file] = source
+    manifest['file'] = manifest['file'].map(lambda file: os.path.basename(paths[file]))
+    manifest['source_bytes'] = manifest['bytes']
+    manifest['bytes'] = manifest['source'].map(lambda source: os.path.getsize(paths[os.path.basename(source)]))
+    fill_media_folder({os.path.basename(path): path for path in paths.values()})
+
+    # Bytes saved per kind of media, counting every file once.
+    report = manifest.drop_duplicates('source').groupby('kind')[['source_bytes', 'bytes']].sum()
+    report['saved'] = report['source_bytes'] - report['bytes']
+    for kind, saved in report['saved'].items():
+        count('transcode_bytes_saved_total', int(saved), kind=kind)
+    print((report / 1e6).round(1).rename(columns=lambda column: column + ' (MB)').to_string())
+
+    with timed_io('write', OUTPUT_FILES['media_files']):
+        manifest[FILES_COLUMNS].to_csv(OUTPUT_FILES['media_files'], index=False)
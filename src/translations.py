@@ -1,44 +1,65 @@
 import pandas as pd
 from file_paths import INPUT_FILES, PROCESSED_FILES
-from string import capwords
+from utils import read_excel_cached
+from names import NameIndex
+from store import save_to_store
+from metrics import count, timer, timed_io
 
 LANGUAGES = ['Afrikaans', 'Albanian', 'Arabic', 'Armenian', 'Azerbaijani', 'Belarusian', 'Bengali', 'Bulgarian', 'Catalan', 'Chinese', 'Chinese (Traditional)', 'Croatian', 'Czech', 'Danish', 'Dutch', 'Estonian', 'Faroese', 'Finnish', 'French', 'Galician', 'Georgian', 'German', 'Greek', 'Hebrew', 'Hungarian', 'Icelandic', 'Indonesian', 'Italian', 'Japanese', 'Kazakh', 'Korean', 'Latvian', 'Lithuanian', 'Macedonian', 'Marathi', 'Malay', 'Maltese', 'Mongolian', 'Nepali', 'Norwegian', 'Persian', 'Polish', 'Portuguese', 'Romanian', 'Russian', 'Serbian', 'Slovak', 'Slovenian', 'Spanish', 'Swahili', 'Swedish', 'Tajik', 'Thai', 'Turkish', 'Ukrainian', 'Uzbek', 'Vietnamese']
 
-def merge_excel_translations(df):
+TRANSLATION_COLUMNS = ['Scientific (Clements)', 'language', 'name']
+
+def stack_translations(wide, species):
     """
-    Merge translation data from the IOC file.
+    Long (species, language) -> name Series of the non-empty names in the LANGUAGES columns of a wide table,
+    with species giving the Scientific (Clements) name of each row.
     """
-    df_excel = pd.read_excel(INPUT_FILES["ioc_translations"], dtype="str")
-    df = pd.merge(df, df_excel, left_on='Scientific (IOC)', right_on="IOC14.2", how="left")
-    
-    return df
+    languages = [col for col in LANGUAGES if col in wide.columns]
+    long = wide[languages].set_axis(species.values).rename_axis('Scientific (Clements)')
+    long = long.melt(var_name='language', value_name='name', ignore_index=False).dropna(subset=['name'])
+    return long.set_index('language', append=True)['name']
+
+def excel_translations(df):
+    """
+    Translation data from the IOC file, matched on the IOC scientific name.
+    """
+    df_excel = read_excel_cached(INPUT_FILES["ioc_translations"], dtype="str")
+    df_excel = df_excel.dropna(subset=['IOC14.2']).drop_duplicates(subset='IOC14.2').set_index('IOC14.2')
 
+    return stack_translations(df_excel.reindex(df['Scientific (IOC)']), df['Scientific (Clements)'])
 
-def merge_csv_translations(df):
+
+def csv_translations(df):
     """
-    Merge additional translation data from the first version where additional
-    translations were scraped from Avibase.
+    Additional translation data from the first version where additional
+    translations were scraped from Avibase, matched on the normalized English name
+    and on the scientific name, in that order of priority.
     """
-    df_old = pd.read_csv(INPUT_FILES["old_version"], dtype="str")
-    
-    # Merge on English name first.
-    merged_df = pd.merge(df, df_old, left_on='English (Clements)', right_on='PRIMARY_COM_NAME', how="left", suffixes=["", "_old"])
-    
-    # Update missing values for each specified language column from CSV merge.
-    for col in LANGUAGES:
-        csv_col = f"{col}_old"
-        if col in merged_df.columns and csv_col in merged_df.columns:
-            merged_df[col] = merged_df[col].fillna(merged_df[csv_col])
-    
-    # Merge on Scientific name to pick up any remaining missing translations.
-    merged_df = pd.merge(merged_df, df_old, left_on='Scientific (Clements)', right_on='SCI_NAME', how="left", suffixes=["", "_old_2"])
-    
-    for col in LANGUAGES:
-        csv_col_2 = f"{col}_old_2"
-        if col in merged_df.columns and csv_col_2 in merged_df.columns:
-            merged_df[col] = merged_df[col].fillna(merged_df[csv_col_2])
+    with timed_io('read', INPUT_FILES["old_version"]):
+        df_old = pd.read_csv(INPUT_FILES["old_version"], dtype="str")
+
+    translations = []
+    for column, index, normalized in [
+        ('English (Clements)', NameIndex(df_old, 'PRIMARY_COM_NAME'), True),
+        ('Scientific (Clements)', NameIndex(df_old, 'SCI_NAME'), False),
+    ]:
+        rows = index.lookup(df[column], normalized=normalized)
+        translations.append(stack_translations(index.df.reindex(rows.values), df['Scientific (Clements)']))
     
-    return merged_df
+    return translations
+
+
+def capitalize_translations(names):
+    """
+    Titlelize translations if the first letter is not capitalized, like string.capwords
+    but for every name at once: split on whitespace, capitalize each word and join with single spaces.
+    """
+    lower = names.str[0].str.islower().fillna(False).astype(bool)
+    words = names[lower].str.split().explode()
+    capitalized = words.str.capitalize().groupby(level=list(range(names.index.nlevels)), sort=False).agg(' '.join)
+    names = names.copy()
+    names[lower] = capitalized.reindex(names.index[lower])
+    return names
 
 
 def merge_translations(base_df):
@@ -47,26 +68,34 @@ def merge_translations(base_df):
       1. Excel file (Multiling IOC 14.2_b.xlsx)
       2. CSV file (Ultimate Birds - old version.csv)
     
-    The DataFrame is reindexed to include scientific name and all language columns.
+    Names from the old version only fill in the (species, language) pairs the IOC file has no name for.
     
-    Saves the final CSV to PROCESSED_FILES['translations'].
+    Saves the final gzip'd CSV to PROCESSED_FILES['translations'] in long format: one row per
+    species and language with a name, see load_translations to get one column per language.
     """
     print("-------- Merging translations --------")
-    pd.set_option("future.no_silent_downcasting", True)
-    
-    df = base_df[['English (Clements)', 'Scientific (Clements)', 'English (IOC)', 'Scientific (IOC)']].copy()
+    df = base_df[['English (Clements)', 'Scientific (Clements)', 'English (IOC)', 'Scientific (IOC)']].drop_duplicates(subset='Scientific (Clements)')
 
-    # Merge Excel translations.
-    df_merged = merge_excel_translations(df)
+    translations = excel_translations(df)
+    old_translations = csv_translations(df)
+    with timer('merge_seconds', step='old translations'):
+        for old in old_translations:
+            translations = translations.combine_first(old)
 
-    # Merge additional CSV translations.
-    df_merged = merge_csv_translations(df_merged)
+    with timer('capitalize_seconds'):
+        translations = capitalize_translations(translations)
 
-    # Titlelize translations if it the first letter is not capitalized.
-    for col in LANGUAGES:
-        df_merged[col] = df_merged[col].apply(lambda x: capwords(x) if not pd.isna(x) and x[0].islower() else x)
+    # The species and language names repeat on every row, so the file is gzip'd (without a timestamp, so unchanged data gives the same file).
+    count('rows_processed_total', len(translations))
+    with timed_io('write', PROCESSED_FILES["translations"]):
+        translations.rename('name').reset_index()[TRANSLATION_COLUMNS].to_csv(PROCESSED_FILES["translations"], index=False,
+                                                                             compression={'method': 'gzip', 'mtime': 0})
+    save_to_store('translations')
 
-    final_columns = ['Scientific (Clements)'] + LANGUAGES
-    df_merged = df_merged.reindex(columns=final_columns)
-    
-    df_merged.to_csv(PROCESSED_FILES["translations"], index=False)
+
+def load_translations(file=PROCESSED_FILES["translations"]):
+    """
+    Pivot the long translations file back to one row per species and one column per language, in the order of LANGUAGES.
+    """
+    translations = pd.read_csv(file, dtype="str", na_values=[''], keep_default_na=False)
+    return translations.pivot(index='Scientific (Clements)', columns='language', values='name').reindex(columns=LANGUAGES).rename_axis(columns=None)
@@ -1,4 +1,17 @@
-from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context
+from contextvars import copy_context
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlparse
+from file_paths import CACHE_FILES
+from tqdm import tqdm
+import pandas as pd
+import http_cache
+import metrics
+import threading
+import queue
+import hashlib
+import os
 import requests
 import time
 
@@ -10,20 +23,306 @@ def escape_characters(text):
 
 
 """
-Get the URL content, but retry a few times if there's an error
+SHA-256 of a file's content, read in blocks so large archives don't have to fit in memory
+"""
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+"""
+Read the first sheet of an Excel workbook, parsing each version of the file at most once.
+Parsed sheets are kept for the rest of the process and saved as a pickle keyed by the file's hash,
+so later runs skip openpyxl entirely until the workbook changes.
+"""
+_workbooks = {}
+_workbooks_lock = threading.Lock()
+
+def read_excel_cached(path, dtype=None):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size, str(dtype))
+    with _workbooks_lock:
+        if key not in _workbooks:
+            name = os.path.splitext(os.path.basename(path))[0]
+            snapshot = os.path.join(CACHE_FILES['excel'], f'{name}-{file_hash(path)[:16]}-{dtype or "auto"}.pkl')
+            if os.path.exists(snapshot):
+                metrics.count('excel_cache_total', result='hit')
+                df = pd.read_pickle(snapshot)
+            else:
+                metrics.count('excel_cache_total', result='miss')
+                with metrics.timed_io('read_excel', path):
+                    df = pd.read_excel(path, dtype=dtype)
+                os.makedirs(CACHE_FILES['excel'], exist_ok=True)
+                df.to_pickle(snapshot + '.tmp')
+                os.replace(snapshot + '.tmp', snapshot)
+            _workbooks[key] = df
+        else:
+            metrics.count('excel_cache_total', result='memory')
+        return _workbooks[key].copy()
+
+
+"""
+Throttle requests so that a host receives at most a fixed number of requests per second
+"""
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # Reserve the next free slot under the lock, then sleep outside it so other threads can queue up.
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        # Push back every queued request for this host, e.g. after a 429 with Retry-After.
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+"""
+Retry and throttling policy for a single host.
+Hosts without an entry in HOST_POLICIES get a policy with the default values.
 """
 MAX_RETRIES = 3
 RETRY_DELAY = 2
+REQUESTS_PER_SECOND = 5
+TIMEOUT = 120
+
+class HostPolicy:
+    def __init__(self, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY, requests_per_second=REQUESTS_PER_SECOND, timeout=TIMEOUT):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+    def backoff(self, attempt, response=None):
+        """Seconds to wait after a failed attempt, preferring the server's Retry-After when it is longer."""
+        delay = self.retry_delay * 2 ** attempt
+        retry_after = get_retry_after(response)
+        if retry_after is not None and retry_after > delay:
+            delay = retry_after
+        if retry_after is not None:
+            self.rate_limiter.pause(delay)
+        return delay
+
+HOST_POLICIES = {
+    'ebird.org': HostPolicy(),
+    'avibase.bsc-eoc.org': HostPolicy(),
+}
+_host_policies_lock = threading.Lock()
+
+def get_host_policy(url):
+    host = urlparse(url).netloc
+    with _host_policies_lock:
+        if host not in HOST_POLICIES:
+            HOST_POLICIES[host] = HostPolicy()
+        return HOST_POLICIES[host]
+
+def get_retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+"""
+Shared HTTP session so connections are kept alive and reused instead of opening a new TCP/TLS connection per URL.
+Each host gets its own pool of up to POOL_SIZE connections, which blocks instead of overflowing when
+more threads than that share the session.
+"""
+POOL_SIZE = 8
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(HOST_POLICIES), pool_maxsize=POOL_SIZE, pool_block=True)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers.update({
+                'User-Agent': 'Mozilla/5.0',
+                'From': 'bjorn60@gmail.com',
+                # Includes br (and zstd) when the optional decoders for urllib3 are installed.
+                'Accept-Encoding': requests.utils.DEFAULT_ACCEPT_ENCODING,
+            })
+        return _session
 
-def fetch_url(url):
-    for i in range(MAX_RETRIES):
+
+"""
+Get the URL content, but retry a few times if there's an error.
+The delay doubles on every attempt unless the server asks for a specific delay with Retry-After.
+Responses are kept in the on-disk cache and revalidated with conditional requests once they are older than
+http_cache.CACHE_TTL. With http_cache.OFFLINE set, only cached responses are returned.
+"""
+def fetch_url(url, use_cache=True):
+    host = urlparse(url).netloc
+    cache = http_cache.get_response_cache() if use_cache else None
+    cached = cache.get(url) if cache else None
+    if cached and (http_cache.OFFLINE or cached.is_fresh()):
+        metrics.count('http_cache_total', host=host, result='hit')
+        return cached.to_response()
+    if http_cache.OFFLINE:
+        metrics.count('http_cache_total', host=host, result='offline_miss')
+        print(f"Offline and not cached: {url}")
+        return None
+
+    headers = cached.conditional_headers() if cached else {}
+    session = get_session()
+    policy = get_host_policy(url)
+    for i in range(policy.max_retries):
+        if i:
+            metrics.count('http_retries_total', host=host)
+        policy.rate_limiter.wait()
+        start = time.perf_counter()
         try:
-            response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0', 'From': 'bjorn60@gmail.com'}, timeout=120)
+            response = session.get(url, headers=headers, timeout=policy.timeout)
+            metrics.observe('http_request_seconds', time.perf_counter() - start, host=host)
+            metrics.count('http_requests_total', host=host, status=response.status_code)
+            metrics.count('http_bytes_downloaded_total', len(response.content), host=host)
+            if response.status_code == 304 and cached:
+                metrics.count('http_cache_total', host=host, result='revalidated')
+                cache.touch(url)
+                return cached.to_response()
             response.raise_for_status()  # Raise an exception for HTTP errors (4xx or 5xx)
+            if cache:
+                metrics.count('http_cache_total', host=host, result='miss')
+                cache.put(url, response)
             return response
         except requests.exceptions.RequestException as e:
+            if e.response is None:
+                metrics.count('http_requests_total', host=host, status='error')
             print(f"Attempt {i + 1}: Error accessing {url} - {e}")
-            if i < MAX_RETRIES - 1:  # Don't wait on the last retry
-                time.sleep(RETRY_DELAY)  # Add a delay before retrying
-    print(f"Failed to access {url} after {MAX_RETRIES} attempts.")
-    return None
\ No newline at end of file
+            if i < policy.max_retries - 1:  # Don't wait on the last retry
+                time.sleep(policy.backoff(i, e.response))  # Add a delay before retrying
+    metrics.count('http_failures_total', host=host)
+    print(f"Failed to access {url} after {policy.max_retries} attempts.")
+    return None
+
+
+"""
+Run func over all items with a bounded thread pool and return the results in input order.
+Combined with the per-host rate limiter in fetch_url this keeps scraping fast but polite.
+"""
+MAX_WORKERS = POOL_SIZE
+
+def map_concurrent(func, items, desc=None, max_workers=None):
+    items = list(items)
+    # The workers run in the caller's context, so their metrics are labelled with the caller's stage.
+    context = copy_context()
+    run = lambda item: context.copy().run(func, item)
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_WORKERS) as executor:
+        return list(tqdm(executor.map(run, items), total=len(items), desc=desc))
+
+
+"""
+Match tags with any of the given classes in a SoupStrainer.
+The strainer sees the raw class attribute while parsing, so a tag with several classes would otherwise not match.
+"""
+def has_class(*classes):
+    return lambda value: value is not None and not set(classes).isdisjoint(value.split() if isinstance(value, str) else value)
+
+
+"""
+Fetch pages on I/O threads and parse them in a pool of processes, so parsing doesn't compete with the network
+threads for the GIL. Each job is (url, parse, args) and parse(content, *args) has to be a module-level function
+that returns picklable data.
+Fetched pages wait in a queue of PARSE_QUEUE_SIZE pages and at most that many are being parsed at once,
+so fetchers pause when parsing falls behind instead of keeping every page in memory.
+Yields (url, result) as pages are parsed, with result None if the page could not be fetched or parsed.
+"""
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+PARSE_QUEUE_SIZE = 4 * POOL_SIZE
+
+def timed_parse(parse, content, args):
+    start = time.perf_counter()
+    result = parse(content, *args)
+    return result, time.perf_counter() - start
+
+def fetch_and_parse(jobs, desc=None, fetch_workers=None, parse_workers=None):
+    jobs = list(jobs)
+    if not jobs:
+        return
+    pages = queue.Queue(maxsize=PARSE_QUEUE_SIZE)
+    stopped = threading.Event()
+    context = copy_context()
+
+    def fetch(job):
+        if stopped.is_set():
+            return
+        response = None
+        try:
+            response = fetch_url(job[0])
+        except Exception as e:
+            print(f"Error fetching {job[0]}: {e}")
+        finally:
+            # Nothing takes pages from the queue anymore once parsing stopped, so fetchers don't wait for room then.
+            while not stopped.is_set():
+                try:
+                    pages.put((job, response.content if response else None), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    parse_seconds = 0.0
+    parsed = 0
+    # Spawned instead of forked, forking a process with running threads can deadlock.
+    with ThreadPoolExecutor(max_workers=fetch_workers or MAX_WORKERS) as fetchers, \
+            ProcessPoolExecutor(max_workers=parse_workers or PARSE_WORKERS, mp_context=get_context('spawn')) as parsers, \
+            tqdm(total=len(jobs), desc=desc) as progress:
+        for job in jobs:
+            fetchers.submit(context.copy().run, fetch, job)
+
+        # Stop the fetchers when the caller stops early or parsing fails, instead of waiting for them forever.
+        try:
+            parsing = {}
+            received = 0
+            while received < len(jobs) or parsing:
+                if received < len(jobs) and len(parsing) < PARSE_QUEUE_SIZE:
+                    (url, parse, args), content = pages.get()
+                    received += 1
+                    if content is None:
+                        progress.update()
+                        yield url, None
+                    else:
+                        parsing[parsers.submit(timed_parse, parse, content, args)] = (url, parse)
+                    continue
+
+                finished, _ = wait(parsing, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    url, parse = parsing.pop(future)
+                    progress.update()
+                    try:
+                        result, seconds = future.result()
+                    except Exception as e:
+                        print(f"Error parsing {url}: {e}")
+                        yield url, None
+                        continue
+                    metrics.observe('html_parse_seconds', seconds, parser=parse.__name__)
+                    parse_seconds += seconds
+                    parsed += 1
+                    yield url, result
+        finally:
+            stopped.set()
+            fetchers.shutdown(cancel_futures=True)
+            parsers.shutdown(cancel_futures=True)
+
+    if parsed:
+        print(f"Parsed {parsed} pages in {parse_seconds:.1f}s ({1000 * parse_seconds / parsed:.1f} ms per page)")
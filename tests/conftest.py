@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules in src import each other by their bare names, as main.py runs from src.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
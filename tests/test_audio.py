@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import tracemalloc
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import audio
+from benchmarks import fixtures
+from benchmarks.fixtures import make_species, write_audio_archive
+
+SPECIES = 300
+
+def get_audio(streaming):
+    """Run get_audio under tracemalloc, returning audio.csv and the peak memory in bytes."""
+    tracemalloc.start()
+    try:
+        audio.get_audio(make_species(SPECIES), streaming=streaming)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    with open(audio.PROCESSED_FILES['audio']) as file:
+        return file.read(), peak
+
+def test_streaming(tmp_path, monkeypatch):
+    """
+    Test that streaming selects the same recordings as loading the archive, with a lower peak memory.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(audio, 'save_to_store', lambda stage: None)
+    monkeypatch.setattr(audio, 'STREAMING_CHUNK_SIZE', 2000)
+    # Many recordings per species, of which only the ten best are kept.
+    monkeypatch.setattr(fixtures, 'RECORDINGS_PER_SPECIES', 100)
+    os.makedirs(os.path.dirname(audio.INPUT_FILES['audio_files']))
+    os.makedirs(os.path.dirname(audio.PROCESSED_FILES['audio']))
+    write_audio_archive(make_species(SPECIES), np.random.default_rng(0))
+
+    in_memory, in_memory_peak = get_audio(streaming=False)
+    streamed, streamed_peak = get_audio(streaming=True)
+
+    assert pd.read_csv(audio.PROCESSED_FILES['audio'])['SOUNDS'].count() == SPECIES
+    assert streamed == in_memory
+    assert streamed_peak < in_memory_peak
@@ -0,0 +1,55 @@
+from bs4 import BeautifulSoup
+import pandas as pd
+import pytest
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import avibase
+from src.journal import Journal
+
+CHECKLIST = ('<table><tr class="reg3"><td><a href="checklist.jsp?region=BR">Brazil</a>'
+             '<a href="checklist.jsp?region=BR&amp;list=full">Regions</a></td></tr></table>')
+REGIONS = '<table><tr class="reg4"><td><a href="checklist.jsp?region=BR-1">Region 1</a></td></tr></table>'
+COUNTRY_URL = avibase.BASE_URL_AVIBASE + 'checklist.jsp?region=BR'
+REGIONS_URL = avibase.BASE_URL_AVIBASE + 'checklist.jsp?region=BR&list=full'
+REGION_URL = avibase.BASE_URL_AVIBASE + 'checklist.jsp?region=BR-1'
+
+def scrape_avibase(tmp_path, monkeypatch, pages, selenium):
+    """
+    Scrape a checklist with one diverse country, with the results of fetch_and_parse taken from pages.
+    With selenium, the regions are expanded in Chrome instead, from the page source at REGIONS_URL in pages.
+    """
+    journal = lambda stage: Journal(stage, tmp_path / 'journal.sqlite', version='v1')
+    monkeypatch.setattr(avibase, 'Journal', journal)
+    monkeypatch.setattr(avibase, 'save_to_store', lambda stage: None)
+    monkeypatch.setitem(avibase.PROCESSED_FILES, 'avibase', str(tmp_path / 'avibase.csv'))
+    monkeypatch.setattr(avibase, 'USE_SELENIUM', selenium)
+    monkeypatch.setattr(avibase, 'fetch_country_list', lambda: BeautifulSoup(CHECKLIST, 'lxml').find_all('tr', class_='reg3'))
+    monkeypatch.setattr(avibase, 'fetch_and_parse', lambda jobs, desc=None: ((url, pages.get(url)) for url, _, _ in jobs))
+
+    def page_source(country_name):
+        if REGIONS_URL not in pages:
+            raise RuntimeError('Chrome crashed')
+        return REGIONS
+    monkeypatch.setattr(avibase, 'fetch_page_source_selenium', page_source)
+
+    avibase.scrape_avibase_data(pd.DataFrame({'Scientific (Clements)': ['Alpha one'], 'English (Clements)': ['Alpha Bird']}))
+    return pd.read_csv(avibase.PROCESSED_FILES['avibase']), journal('avibase')
+
+@pytest.mark.parametrize('selenium', [False, True])
+def test_failed_region_list(tmp_path, monkeypatch, selenium):
+    """
+    Test that a country whose list of regions failed is retried, instead of silently losing its region tags.
+    """
+    pages = {COUNTRY_URL: [('Alpha Bird', 'UB::Brazil::Common ', 'species.jsp?id=1', 'Least concern')]}
+
+    df, journal = scrape_avibase(tmp_path, monkeypatch, pages, selenium)
+    assert df.loc[0, 'TAGS'] == 'UB::Brazil::Common '
+    assert journal.failed() == [COUNTRY_URL]
+
+    pages[REGIONS_URL] = [('checklist.jsp?region=BR-1', 'Region 1')]
+    pages[REGION_URL] = [('Alpha Bird', 'UB::Brazil::Region-1::Common ')]
+    df, journal = scrape_avibase(tmp_path, monkeypatch, pages, selenium)
+    assert df.loc[0, 'TAGS'] == 'UB::Brazil::Common UB::Brazil::Region-1::Common '
+    assert journal.failed() == []
@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.journal import Journal, finish_journal
+from src.images import parse_species_page
+
+def open_journal(tmp_path, stage='images', version='v1', **kwargs):
+    return Journal(stage, tmp_path / 'journal.sqlite', version=version, **kwargs)
+
+def test_resume(tmp_path):
+    """
+    Test that a reopened journal resumes with the successful results, and keeps the failures to retry.
+    """
+    journal = open_journal(tmp_path)
+    journal.record('page-1', ['images', 'text'])
+    journal.record_failure('page-2')
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    assert journal.completed() == {'page-1': ['images', 'text']}
+    assert journal.failed() == ['page-2']
+    # Other stages have a journal of their own in the same file.
+    assert open_journal(tmp_path, stage='avibase').completed() == {}
+
+def test_finish_journal(tmp_path):
+    """
+    Test that a run with failures keeps the journal, and a run without failures clears it.
+    """
+    journal = open_journal(tmp_path)
+    journal.record('page-1', ['images', 'text'])
+    journal.record_failure('page-2')
+    finish_journal(journal)
+    assert journal.completed() == {'page-1': ['images', 'text']}
+
+    journal.record('page-2', ['images', 'text'])
+    finish_journal(journal)
+    assert journal.completed() == {}
+    assert journal.failed() == []
+
+def test_other_base_data(tmp_path):
+    """
+    Test that the progress for another version of the base data is dropped, however recent it is.
+    """
+    journal = open_journal(tmp_path)
+    journal.record('page-1', ['images', 'text'])
+    journal.record_failure('page-2')
+    journal.close()
+
+    journal = open_journal(tmp_path, version='v2')
+    assert journal.completed() == {}
+    assert journal.failed() == []
+
+def test_expired_entries(tmp_path):
+    """
+    Test that an interrupted run can be resumed days later, but not after the maximum age.
+    """
+    journal = open_journal(tmp_path)
+    journal.record('page-1', ['images', 'text'])
+    journal.db.execute('UPDATE entries SET recorded_at = recorded_at - 3 * 24 * 60 * 60')
+    journal.close()
+
+    assert open_journal(tmp_path).completed() == {'page-1': ['images', 'text']}
+    assert open_journal(tmp_path, max_age_days=2).completed() == {}
+
+def test_species_page_without_images():
+    """
+    Test that a species page without photos is scraped as empty instead of failing, so it doesn't keep the journal.
+    """
+    assert parse_species_page(b'<html><body><p>No photos yet</p></body></html>', 'species/none') == ['', '']
@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import pipeline
+from src.pipeline import Pipeline, Stage
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+def toy_stages(tmp_path, monkeypatch):
+    """
+    Replace the stages with a chain of three, source -> middle -> sink, that copy a file along.
+    Returns the list the names of the stages that ran are appended to.
+    """
+    ran = []
+    def copy(name, source, target):
+        def run(options):
+            ran.append(name)
+            with open(source) as f:
+                write(target, f.read())
+        return Stage(name, run, inputs=[source], outputs=[target], code=['names.py'])
+
+    paths = [str(tmp_path / name) for name in ['input', 'source', 'middle', 'sink']]
+    monkeypatch.setattr(pipeline, 'STAGES', {stage.name: stage for stage in [
+        copy('source', paths[0], paths[1]),
+        copy('middle', paths[1], paths[2]),
+        copy('sink', paths[2], paths[3]),
+    ]})
+    write(paths[0], 'v1')
+    return ran, paths
+
+def test_existing_outputs(tmp_path, monkeypatch):
+    """
+    Test that outputs from before the pipeline state existed are taken as up to date,
+    but not the ones downstream of a stage that had to run.
+    """
+    ran, paths = toy_stages(tmp_path, monkeypatch)
+    for path in paths[1:]:
+        write(path, 'v1')
+    state_file = str(tmp_path / 'pipeline.json')
+
+    assert Pipeline({}, state_file).run()
+    assert ran == []
+
+    os.remove(state_file)
+    write(paths[0], 'v2')
+    os.remove(paths[1])
+    assert Pipeline({}, state_file).run()
+    assert ran == ['source', 'middle', 'sink']
+
+def test_no_deps(tmp_path, monkeypatch):
+    """
+    Test that with no_deps only the given stages run, unless the outputs of a stage they depend on are missing.
+    """
+    ran, paths = toy_stages(tmp_path, monkeypatch)
+    state_file = str(tmp_path / 'pipeline.json')
+    assert Pipeline({}, state_file).run()
+    ran.clear()
+
+    # The source is out of date, but only the sink was asked for.
+    write(paths[0], 'v2')
+    assert Pipeline({}, state_file).run(['sink'], force={'sink'}, no_deps=True)
+    assert ran == ['sink']
+
+    ran.clear()
+    os.remove(paths[2])
+    assert Pipeline({}, state_file).run(['sink'], force={'sink'}, no_deps=True)
+    assert ran == ['middle', 'sink']
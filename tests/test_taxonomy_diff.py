@@ -0,0 +1,96 @@
+import pandas as pd
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import taxonomy_diff
+from src.taxonomy_diff import classify_species, split_unchanged, with_reused
+
+def base_data(rows):
+    """Base data with the SPECIES_CODE and name columns, from (code, English, Scientific) rows with the same IOC names."""
+    return pd.DataFrame([{
+        'SPECIES_CODE': code,
+        'English (Clements)': english, 'Scientific (Clements)': scientific,
+        'English (IOC)': english, 'Scientific (IOC)': scientific,
+    } for code, english, scientific in rows])
+
+PREVIOUS = base_data([
+    ('alpha', 'Alpha Bird', 'Alpha one'),
+    ('beta', 'Beta Bird', 'Beta two'),
+    ('gamma', 'Gamma Bird', 'Gamma three'),
+    ('delta', 'Delta Bird', 'Delta four'),
+    ('eps', 'Epsilon Bird', 'Epsilon five'),
+    ('zeta', 'Zeta Bird', 'Zeta six'),
+])
+CURRENT = base_data([
+    ('alpha', 'Alpha Bird', 'Alpha one'),        # unchanged
+    ('beta', 'Beta Birdie', 'Beta two'),         # renamed: same code, other English name
+    ('gamma2', 'Gamma Bird', 'Gamma three'),     # renamed: other code, found by its scientific name
+    ('delta', 'Delta Bird', 'Delta four'),       # split: had a part split off
+    ('delta1', 'Western Delta', 'Delta west'),   # split: was a group of delta
+    ('zeta', 'Zeta Bird', 'Zeta six'),           # lumped: eps is a group of it now
+    ('new', 'New Bird', 'Nova seven'),           # new
+])
+PREVIOUS_REPORTED_AS = pd.Series({'delta1': 'delta'})
+CURRENT_REPORTED_AS = pd.Series({'eps': 'zeta'})
+
+def test_classify_species():
+    """
+    Test that every species gets the change it went through, and the code and name it had before.
+    """
+    df = classify_species(CURRENT, PREVIOUS, PREVIOUS_REPORTED_AS, CURRENT_REPORTED_AS).set_index('SPECIES_CODE')
+
+    assert df['CHANGE'].to_dict() == {
+        'alpha': 'unchanged', 'beta': 'renamed', 'gamma2': 'renamed', 'delta': 'split',
+        'delta1': 'split', 'zeta': 'lumped', 'new': 'new',
+    }
+    assert df.loc['gamma2', 'PREVIOUS_CODE'] == 'gamma'
+    assert df.loc['gamma2', 'Scientific (previous)'] == 'Gamma three'
+    assert pd.isna(df.loc['new', 'PREVIOUS_CODE'])
+
+def test_classify_species_without_taxonomies():
+    """
+    Test that without the eBird taxonomies, splits show up as new species and lumps as unchanged or renamed.
+    """
+    df = classify_species(CURRENT, PREVIOUS).set_index('SPECIES_CODE')
+
+    assert df.loc['delta1', 'CHANGE'] == 'new'
+    assert df.loc['delta', 'CHANGE'] == 'unchanged'
+    assert df.loc['zeta', 'CHANGE'] == 'unchanged'
+
+def test_split_unchanged(tmp_path, monkeypatch):
+    """
+    Test that only unchanged species with a previous row are reused, and that the rows come back in the order of the species.
+    """
+    monkeypatch.setitem(taxonomy_diff.OUTPUT_FILES, 'taxonomy_diff', str(tmp_path / 'taxonomy_diff.csv'))
+    pd.DataFrame({
+        'Scientific (Clements)': ['Alpha one', 'Beta two', 'Zeta six', 'Nova seven'],
+        'CHANGE': ['unchanged', 'renamed', 'unchanged', 'new'],
+    }).to_csv(taxonomy_diff.OUTPUT_FILES['taxonomy_diff'], index=False)
+    processed_file = tmp_path / 'images.csv'
+    pd.DataFrame({
+        'Scientific (Clements)': ['Alpha one', 'Beta two'],
+        'IMAGES': ['old alpha', 'old beta'],
+    }).to_csv(processed_file, index=False)
+
+    species = pd.Series(['Alpha one', 'Beta two', 'Zeta six', 'Nova seven'], name='Scientific (Clements)')
+    df, reused = split_unchanged(pd.DataFrame({'Scientific (Clements)': species}), processed_file)
+
+    # Zeta is unchanged but has no previous row, so it is processed like the changed species.
+    assert list(df['Scientific (Clements)']) == ['Beta two', 'Zeta six', 'Nova seven']
+    assert list(reused['Scientific (Clements)']) == ['Alpha one']
+
+    df['IMAGES'] = ['new beta', 'new zeta', 'new nova']
+    df = with_reused(df, reused, species)
+    assert list(df['Scientific (Clements)']) == list(species)
+    assert list(df['IMAGES']) == ['old alpha', 'new beta', 'new zeta', 'new nova']
+
+def test_split_unchanged_without_processed_file(tmp_path):
+    """
+    Test that every species is processed when there is no previous output.
+    """
+    df = pd.DataFrame({'Scientific (Clements)': ['Alpha one', 'Beta two']})
+    to_process, reused = split_unchanged(df, tmp_path / 'missing.csv')
+
+    assert to_process.equals(df)
+    assert reused is None